@@ -0,0 +1,199 @@
+# batch.py
+"""Run the chat prompt pipeline over many inputs without the UI.
+
+Input is JSONL (one object per line) or CSV with at least a "prompt" field.
+Optional fields are "id" (defaults to the row number), "files" (paths; a
+JSON list, or ";"-separated in CSV) and any option name (short, interactive,
+jobs, image, code_block) to override the CLI flags for that row.
+Results are appended to the output JSONL as they finish, so an interrupted
+run resumes by skipping ids that already have a successful result.
+
+    python batch.py jobs.jsonl results.jsonl --model gpt-5-mini --jobs --concurrency 8
+    python batch.py jobs.csv results.jsonl --model gpt-5-mini --jobs --batch-api
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from history import materialize_messages
+from pipeline import OPTION_NAMES, LocalFile, build_user_message, client_for, complete, prepare
+from utils import HTTP_MAX_RETRIES, provider_for
+
+BATCH_POLL_SECONDS = 30
+
+
+def read_inputs(path):
+    with open(path, newline="") as f:
+        if path.endswith(".csv"):
+            rows = list(csv.DictReader(f))
+            for row in rows:
+                row["files"] = [p for p in (row.get("files") or "").split(";") if p]
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+    for i, row in enumerate(rows):
+        # An explicit id of 0 is kept; only a missing or empty one falls back to the row number
+        row["id"] = str(row["id"] if row.get("id") not in (None, "") else i)
+    return rows
+
+
+def completed_ids(path):
+    # Rows that ended with an error are retried on the next run
+    if not os.path.exists(path):
+        return set()
+    done = set()
+    with open(path) as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue  # partial last line after an interruption
+            if "error" not in row:
+                done.add(row["id"])
+    return done
+
+
+def _flag(value):
+    return value if isinstance(value, bool) else str(value).strip().lower() in ("1", "true", "yes", "y")
+
+
+def row_options(row, defaults):
+    options = dict(defaults)
+    for name in OPTION_NAMES:
+        if row.get(name) not in (None, ""):
+            options[name] = _flag(row[name])
+    return options
+
+
+def build_packed(row, model, defaults):
+    files = [LocalFile(path) for path in row.get("files") or []]
+    # strict: a rejected file fails the row rather than running it without the file
+    packed, _ = prepare([build_user_message(row["prompt"], files, model, strict=True)], model, row_options(row, defaults))
+    return packed
+
+
+class ResultWriter:
+    def __init__(self, path):
+        self.file = open(path, "a")
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def write(self, row):
+        with self.lock:
+            self.file.write(json.dumps(row) + "\n")
+            self.file.flush()
+            self.count += 1
+
+    def close(self):
+        self.file.close()
+
+
+def run_concurrent(rows, args, defaults, writer):
+    client = client_for(args.model)
+
+    def run(row):
+        try:
+            reply, stats = complete(client, args.model, build_packed(row, args.model, defaults), kind="batch")
+            return {"id": row["id"], "model": args.model, "output": reply, "stats": stats}
+        except Exception as e:
+            return {"id": row["id"], "model": args.model, "error": str(e)}
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for future in as_completed([executor.submit(run, row) for row in rows]):
+            writer.write(future.result())
+
+
+def run_batch_api(rows, args, defaults, writer):
+    # The batch id is kept next to the output so a rerun resumes polling
+    # instead of submitting (and paying for) the same batch again. These calls
+    # bypass the scheduler, so the SDK does the retrying.
+    client = client_for(args.model).with_options(max_retries=HTTP_MAX_RETRIES)
+    state_path = args.output + ".batch"
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            batch_id = f.read().strip()
+    else:
+        lines = []
+        for row in rows:
+            try:
+                messages = materialize_messages(build_packed(row, args.model, defaults))
+            except Exception as e:
+                writer.write({"id": row["id"], "model": args.model, "error": str(e)})
+                continue
+            lines.append(json.dumps({
+                "custom_id": row["id"],
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {"model": args.model, "messages": messages},
+            }))
+        if not lines:
+            return
+        input_file = client.files.create(file=("batch.jsonl", "\n".join(lines).encode()), purpose="batch")
+        batch_id = client.batches.create(
+            input_file_id=input_file.id, endpoint="/v1/chat/completions", completion_window="24h",
+        ).id
+        with open(state_path, "w") as f:
+            f.write(batch_id)
+
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        print(f"Batch {batch_id}: {batch.status}", file=sys.stderr)
+        if batch.status in ("completed", "failed", "expired", "cancelled"):
+            break
+        time.sleep(BATCH_POLL_SECONDS)
+
+    for file_id in filter(None, [batch.output_file_id, batch.error_file_id]):
+        for line in client.files.content(file_id).text.splitlines():
+            item = json.loads(line)
+            response = item.get("response") or {}
+            if response.get("status_code") == 200:
+                body = response["body"]
+                writer.write({
+                    "id": item["custom_id"], "model": args.model,
+                    "output": body["choices"][0]["message"]["content"], "stats": body.get("usage", {}),
+                })
+            else:
+                writer.write({"id": item["custom_id"], "model": args.model, "error": json.dumps(item.get("error") or response)})
+    os.remove(state_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the chat prompt pipeline over a JSONL or CSV file of inputs.")
+    parser.add_argument("input", help="JSONL or CSV with a 'prompt' field per row.")
+    parser.add_argument("output", help="JSONL results; ids with a successful result are skipped.")
+    parser.add_argument("--model", default="gpt-5-mini")
+    parser.add_argument("--concurrency", type=int, default=4, help="Parallel requests (ignored with --batch-api).")
+    parser.add_argument("--batch-api", action="store_true", help="Submit through the OpenAI Batch API (OpenAI models only).")
+    for name in OPTION_NAMES:
+        parser.add_argument(f"--{name.replace('_', '-')}", dest=name, action="store_true", help=f"Enable the '{name}' option prompt.")
+    args = parser.parse_args()
+    if args.batch_api and provider_for(args.model)[0] != "openai":
+        parser.error(f"--batch-api needs an OpenAI model, not {args.model}")
+
+    defaults = {name: getattr(args, name) for name in OPTION_NAMES}
+    done = completed_ids(args.output)
+    rows = [row for row in read_inputs(args.input) if row["id"] not in done]
+    print(f"{len(rows)} to run, {len(done)} already done", file=sys.stderr)
+    if not rows:
+        return
+
+    writer = ResultWriter(args.output)
+    started = time.perf_counter()
+    try:
+        if args.batch_api:
+            run_batch_api(rows, args, defaults, writer)
+        else:
+            run_concurrent(rows, args, defaults, writer)
+    finally:
+        writer.close()
+        elapsed = time.perf_counter() - started
+        rate = writer.count / elapsed * 60 if elapsed > 0 else 0.0
+        print(f"{writer.count} results in {elapsed:.1f}s ({rate:.1f} requests/min)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+# bench/mock_server.py
+"""Local OpenAI-compatible server for benchmarks.
+
+Serves /v1/chat/completions (blocking and streaming) and
+/v1/images/generations with configurable latency, and records the size of
+every request body so payload growth can be tracked.
+
+    python bench/mock_server.py --port 8765 --latency 0.2 --token-delay 0.01
+"""
+import argparse
+import base64
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 1x1 PNG
+PNG_B64 = base64.b64encode(bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000154a24f5d0000000049454e44ae426082"
+)).decode()
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, token_delay=0.0, tokens=50):
+        super().__init__(address, MockHandler)
+        self.latency = latency
+        self.token_delay = token_delay
+        self.tokens = tokens
+        self.lock = threading.Lock()
+        self.requests = []  # (path, body bytes)
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/v1"
+
+    def record(self, path, size):
+        with self.lock:
+            self.requests.append((path, size))
+
+    def reset(self):
+        with self.lock:
+            self.requests = []
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.record(self.path, len(raw))
+        body = json.loads(raw or b"{}")
+        time.sleep(self.server.latency)
+        if self.path.endswith("/images/generations"):
+            return self._json({"created": int(time.time()), "data": [{"b64_json": PNG_B64}] * body.get("n", 1)})
+        if self.path.endswith("/chat/completions"):
+            return self._stream(body) if body.get("stream") else self._complete(body)
+        self.send_error(404)
+
+    def _usage(self, body):
+        prompt_tokens = sum(len(json.dumps(m.get("content", ""))) // 4 for m in body.get("messages", []))
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": self.server.tokens,
+            "total_tokens": prompt_tokens + self.server.tokens,
+            "prompt_tokens_details": {"cached_tokens": 0},
+        }
+
+    def _complete(self, body):
+        time.sleep(self.server.token_delay * self.server.tokens)
+        self._json({
+            "id": "mock", "object": "chat.completion", "created": int(time.time()), "model": body.get("model"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": "token " * self.server.tokens}}],
+            "usage": self._usage(body),
+        })
+
+    def _stream(self, body):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        base = {"id": "mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": body.get("model")}
+        for _ in range(self.server.tokens):
+            chunk = {**base, "choices": [{"index": 0, "delta": {"content": "token "}, "finish_reason": None}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+            time.sleep(self.server.token_delay)
+        final = {**base, "choices": [], "usage": self._usage(body)}
+        self.wfile.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode())
+        self.close_connection = True
+
+    def _json(self, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_server(host="127.0.0.1", port=0, **kwargs):
+    server = MockOpenAIServer((host, port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before the first byte.")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="Seconds between streamed tokens.")
+    parser.add_argument("--tokens", type=int, default=50, help="Completion tokens per reply.")
+    args = parser.parse_args()
+    server = MockOpenAIServer((args.host, args.port), latency=args.latency, token_delay=args.token_delay, tokens=args.tokens)
+    print(f"Mock OpenAI server on {server.url}")
+    server.serve_forever()
@@ -0,0 +1,254 @@
+# bench/run_bench.py
+"""Headless benchmark of llm-chat.py against the local mock server.
+
+Builds synthetic sessions (10/100/500 turns by default, with and without
+images), runs the app through Streamlit's AppTest and reports, as JSON:
+
+- cold and warm rerun latency of the full script
+- latency of a submitted prompt (includes the mock --latency/--token-delay)
+- request payload bytes seen by the mock server
+- Python memory allocated while loading and rendering the session
+- startup: module import time in a fresh interpreter, first script run
+  and warm rerun of an empty session
+- per-component costs: token counting (cold / cached), history packing and
+  payload construction, upload preprocessing
+
+    python bench/run_bench.py --turns 10 100 --output bench_output.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP = os.path.join(ROOT, "llm-chat.py")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+USERNAME = "bench"
+MODEL = "gpt-4o-mini"
+AUTH_CONFIG = f"""
+cookie:
+  expiry_days: 1
+  key: bench
+  name: bench
+credentials:
+  usernames:
+    {USERNAME}:
+      email: bench@example.com
+      failed_login_attempts: 0
+      first_name: Bench
+      last_name: Mark
+      logged_in: False
+      password: bench
+      roles:
+      - admin
+"""
+
+
+class BenchUpload(io.BytesIO):
+    # Minimal stand-in for Streamlit's UploadedFile
+    def __init__(self, data, name, type):
+        super().__init__(data)
+        self.name, self.type, self.size = name, type, len(data)
+
+
+def synthetic_image():
+    try:
+        from PIL import Image
+    except ImportError:
+        from mock_server import PNG_B64
+        import base64
+        return base64.b64decode(PNG_B64)
+    out = io.BytesIO()
+    Image.effect_noise((1600, 1200), 40).convert("RGB").save(out, "JPEG", quality=90)
+    return out.getvalue()
+
+
+def synthetic_messages(turns, images, image_part):
+    messages = []
+    for i in range(turns):
+        content = [{"type": "text", "text": f"Question {i}: " + "lorem ipsum dolor sit amet " * 40}]
+        if images and i % 5 == 0:
+            content.append(image_part)
+        messages.append({"role": "user", "content": content})
+        messages.append({"role": "assistant", "content": f"Answer {i}: " + "consectetur adipiscing elit " * 60,
+                         "model": MODEL, "stats": {"elapsed": 1.0}})
+    return messages
+
+
+def timed(fn, *args, **kwargs):
+    started = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - started, result
+
+
+def measure_startup(repeats=3):
+    """Import time of the app's helper modules in a fresh interpreter (median)."""
+    code = "import time; t = time.perf_counter(); import utils, history, store, jobs, telemetry; print(time.perf_counter() - t)"
+    times = []
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+        times.append(float(out.stdout.strip().splitlines()[-1]))
+    return statistics.median(times)
+
+
+def measure_components(messages, upload):
+    import utils
+    import uploads
+    from history import pack_messages, materialize_messages
+
+    utils._text_tokens.cache_clear()
+    utils.blob_image_tokens.cache_clear()
+    cold, _ = timed(lambda: [utils.count_tokens(m, MODEL) for m in messages])
+    warm, _ = timed(lambda: [utils.count_tokens(m, MODEL) for m in messages])
+    pack_time, (packed, info) = timed(pack_messages, messages, MODEL, "full")
+    materialize_time, payload = timed(materialize_messages, packed)
+    payload_bytes = len(json.dumps(payload))
+
+    uploads._processed.clear()
+    upload_cold, _ = timed(utils.process_uploaded_files, [upload], MODEL)
+    upload_warm, _ = timed(utils.process_uploaded_files, [upload], MODEL)
+    return {
+        "count_tokens_cold_s": cold,
+        "count_tokens_cached_s": warm,
+        "pack_messages_s": pack_time,
+        "materialize_payload_s": materialize_time,
+        "payload_bytes": payload_bytes,
+        "history_tokens": info["original"],
+        "process_uploads_cold_s": upload_cold,
+        "process_uploads_cached_s": upload_warm,
+    }
+
+
+def new_app_test(session_id, messages, timeout):
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP, default_timeout=timeout)
+    at.session_state["authentication_status"] = True
+    at.session_state["username"] = USERNAME
+    at.session_state["name"] = "Bench"
+    at.session_state["roles"] = ["admin"]
+    at.session_state["current_session"] = session_id
+    at.session_state["active_session"] = session_id
+    at.session_state["messages"] = messages
+    return at
+
+
+def widget(elements, label):
+    return next(e for e in elements if e.label == label)
+
+
+def measure_app(store, server, session_id, reruns, timeout):
+    at = new_app_test(session_id, store.load_messages(USERNAME, session_id), timeout)
+    tracemalloc.start()
+    cold, _ = timed(at.run)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if at.exception:
+        raise RuntimeError(at.exception[0].value)
+
+    widget(at.sidebar.selectbox, "Select Model").set_value(MODEL)
+    widget(at.sidebar.checkbox, "Use cache").set_value(False)
+    at.run()
+    warm = [timed(at.run)[0] for _ in range(reruns)]
+
+    server.reset()
+    at.chat_input[0].set_value("Benchmark prompt")
+    submit, _ = timed(at.run)
+    chat_bytes = [size for path, size in server.requests if path.endswith("/chat/completions")]
+    return {
+        "cold_run_s": cold,
+        "cold_run_peak_memory_bytes": peak,
+        "warm_rerun_s": {
+            "median": statistics.median(warm),
+            "p95": sorted(warm)[max(int(len(warm) * 0.95) - 1, 0)],
+            "runs": len(warm),
+        },
+        "submit_s": submit,
+        "request_payload_bytes": chat_bytes[-1] if chat_bytes else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark llm-chat.py against a local mock OpenAI server.")
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--reruns", type=int, default=5, help="Warm reruns per session.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Mock server latency before the first byte.")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="Mock server delay per streamed token.")
+    parser.add_argument("--timeout", type=float, default=300, help="AppTest timeout per run in seconds.")
+    parser.add_argument("--output", help="Write JSON results here instead of stdout.")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="chatterlit-bench-")
+    with open(os.path.join(workdir, "auth.config.yml"), "w") as f:
+        f.write(AUTH_CONFIG)
+    os.chdir(workdir)
+
+    from mock_server import start_server
+    server = start_server(latency=args.latency, token_delay=args.token_delay)
+    os.environ.update({
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": server.url,
+        "CHATTERLIT_STORE": f"sqlite:///{workdir}/bench.db",
+        "CHATTERLIT_BLOBS": os.path.join(workdir, "blobs"),
+        "CHATTERLIT_CACHE": os.path.join(workdir, "cache.db"),
+    })
+
+    from store import open_store
+    from blobs import get_blob_store, image_ref
+
+    store = open_store()
+    image = synthetic_image()
+    image_part = image_ref(get_blob_store().put(image), "image/jpeg")
+    upload = BenchUpload(image, "photo.jpg", "image/jpeg")
+
+    startup = {"module_import_s": measure_startup()}
+    # First script run in this process (imports, config, authenticator, encoders) vs. a warm rerun
+    at = new_app_test("bench-startup", [], args.timeout)
+    startup["first_run_s"], _ = timed(at.run)
+    startup["warm_rerun_s"] = statistics.median(timed(at.run)[0] for _ in range(args.reruns))
+
+    results = []
+    for turns in args.turns:
+        for images in (False, True):
+            session_id = f"bench-{turns}-{'images' if images else 'text'}"
+            messages = synthetic_messages(turns, images, image_part)
+            for message in messages:
+                store.append_message(USERNAME, session_id, message)
+            result = {"turns": turns, "images": images}
+            result["components"] = measure_components(messages, upload)
+            result["app"] = measure_app(store, server, session_id, args.reruns, args.timeout)
+            results.append(result)
+            print(f"{session_id}: warm rerun {result['app']['warm_rerun_s']['median']:.3f}s", file=sys.stderr)
+
+    import streamlit
+    output = {
+        "meta": {
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "streamlit": streamlit.__version__,
+            "latency": args.latency,
+            "token_delay": args.token_delay,
+        },
+        "startup": startup,
+        "results": results,
+    }
+    text = json.dumps(output, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# blobs.py
+import base64
+import functools
+import hashlib
+import mmap
+import os
+import tempfile
+
+DEFAULT_BLOB_ROOT = "data/blobs"
+CHUNK_SIZE = 64 * 1024
+
+
+class BlobStore:
+    """Content-addressed files: sha256 digest -> root/ab/cdef...
+
+    Identical content is stored once. Reads go through mmap so large
+    images are not copied into Python memory just to be encoded or served.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def put(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temp file and rename so readers never see partial blobs
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return digest
+
+    def put_file(self, file):
+        # Hashed and copied in chunks, so the file is never held in memory whole;
+        # the digest is only known at the end, so the temp file lives in root
+        file.seek(0)
+        h = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(dir=self.root)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while chunk := file.read(CHUNK_SIZE):
+                    h.update(chunk)
+                    f.write(chunk)
+            digest = h.hexdigest()
+            path = self.path(digest)
+            if os.path.exists(path):
+                os.remove(tmp)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return digest
+
+    def read(self, digest, length=None):
+        with open(self.path(digest), "rb") as f:
+            if length is not None:
+                return f.read(length)
+            return f.read()
+
+    def b64encode(self, digest):
+        with open(self.path(digest), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return ""
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return base64.b64encode(mm).decode()
+
+    def data_url(self, digest, mime):
+        return f"data:{mime};base64,{self.b64encode(digest)}"
+
+
+@functools.lru_cache(maxsize=None)
+def get_blob_store(root=None):
+    return BlobStore(root or os.getenv("CHATTERLIT_BLOBS", DEFAULT_BLOB_ROOT))
+
+
+def image_ref(digest, mime):
+    # Message part that points at a blob; expanded to image_url only on the wire
+    return {"type": "image_ref", "blob": digest, "mime": mime}
+
+
+def materialize(content):
+    """Replace image_ref parts with base64 image_url parts for the API payload."""
+    if not isinstance(content, list):
+        return content
+    blobs = get_blob_store()
+    return [
+        {"type": "image_url", "image_url": {"url": blobs.data_url(part["blob"], part["mime"])}}
+        if part["type"] == "image_ref" else part
+        for part in content
+    ]
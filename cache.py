@@ -0,0 +1,134 @@
+# cache.py
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_PATH = "data/cache.db"
+CACHE_TTL = float(os.getenv("CHATTERLIT_CACHE_TTL", str(7 * 24 * 3600)))
+CACHE_MAX_ENTRIES = int(os.getenv("CHATTERLIT_CACHE_MAX_ENTRIES", "5000"))
+
+
+def cache_key(*parts):
+    """Canonical hash of JSON-serializable request parts.
+
+    Packed messages still hold image_ref parts at this point, so uploads are
+    keyed by their content hash rather than by their base64 payload.
+    """
+    canonical = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ResponseCache:
+    """On-disk response cache with a TTL and an LRU cap on the number of entries."""
+
+    def __init__(self, path, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed);
+        """)
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                self.conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                return None
+            self.conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now),
+            )
+            # Evict expired entries, then the least recently used ones over the cap
+            self.conn.execute("DELETE FROM cache WHERE created < ?", (now - self.ttl,))
+            self.conn.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+
+class RedisCache:
+    """ResponseCache on a Redis-compatible server, shared by app replicas.
+
+    Entries expire after the TTL; the entry cap is left to the server's
+    maxmemory policy (e.g. allkeys-lru).
+    """
+
+    def __init__(self, client, ttl=CACHE_TTL, prefix="chatterlit:cache"):
+        self.redis = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url):
+        import redis
+
+        return cls(redis.Redis.from_url(url, decode_responses=True))
+
+    def get(self, key):
+        value = self.redis.get(f"{self.prefix}:{key}")
+        return json.loads(value) if value is not None else None
+
+    def put(self, key, value):
+        self.redis.set(f"{self.prefix}:{key}", json.dumps(value), ex=int(self.ttl))
+
+
+class CacheMapping:
+    """Dict-like view of one namespace of a response cache.
+
+    Lets code written against a plain dict (e.g. the history summaries in
+    history.pack_messages) share its entries across sessions and replicas.
+    """
+
+    def __init__(self, cache, namespace):
+        self.cache = cache
+        self.namespace = namespace
+
+    def __contains__(self, key):
+        return self[key] is not None
+
+    def __getitem__(self, key):
+        return self.cache.get(cache_key(self.namespace, key))
+
+    def __setitem__(self, key, value):
+        self.cache.put(cache_key(self.namespace, key), value)
+
+
+# Backends by URL scheme; anything without a scheme is a SQLite file path
+CACHES = {
+    "sqlite": lambda url: ResponseCache(url[len("sqlite:///"):]),
+    "redis": RedisCache.from_url,
+    "rediss": RedisCache.from_url,
+}
+
+
+def open_cache(url=None):
+    url = url or os.getenv("CHATTERLIT_CACHE", DEFAULT_CACHE_PATH)
+    scheme = url.split("://", 1)[0] if "://" in url else None
+    if scheme is None:
+        return ResponseCache(url)
+    if scheme not in CACHES:
+        raise ValueError(f"Unsupported cache backend: {scheme}")
+    return CACHES[scheme](url)
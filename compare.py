@@ -0,0 +1,63 @@
+# compare.py
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from scheduler import admit
+from telemetry import track, TRACKED_STATS
+from utils import stream_reply, estimate_cost
+
+
+def _stream_model(events, cancelled, model, client, messages, tokens, username):
+    stats = {}
+    try:
+        with admit(model, username, tokens) as lease, track("compare", model, username, messages) as event:
+            started = time.perf_counter()
+            stream = lease.call(
+                client.chat.completions.create,
+                model=model,
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            for delta in stream_reply(stream, model, stats, started):
+                if cancelled.is_set():
+                    # Nobody is reading any more: stop paying for the rest of the reply
+                    stream.close()
+                    raise RuntimeError("Cancelled")
+                events.put((model, delta, None))
+            lease.used(stats)
+            stats["cost"] = estimate_cost(model, stats)
+            event.update({k: stats[k] for k in TRACKED_STATS if k in stats})
+    except Exception as e:
+        stats["error"] = str(e)
+        events.put((model, f"Error: {e}", None))
+    events.put((model, None, stats))
+
+
+def fan_out(requests, username=None):
+    """Stream one prompt from several models concurrently.
+
+    `requests` is a list of (model, client, messages, prompt_tokens). Yields
+    (model, delta, None) for each text delta as it arrives from any model and
+    (model, None, stats) once that model is finished, so the caller can
+    render every model's column from the main script thread.
+
+    Closing the generator early (st.stop, a rerun, an error in the caller)
+    cancels the streams instead of waiting for them to finish.
+    """
+    events, cancelled = queue.Queue(), threading.Event()
+    executor = ThreadPoolExecutor(max_workers=max(len(requests), 1), thread_name_prefix="chatterlit-compare")
+    try:
+        for model, client, messages, tokens in requests:
+            executor.submit(_stream_model, events, cancelled, model, client, messages, tokens, username)
+        remaining = len(requests)
+        while remaining:
+            model, delta, stats = events.get()
+            if delta is None:
+                remaining -= 1
+            yield model, delta, stats
+    finally:
+        cancelled.set()
+        executor.shutdown(wait=False, cancel_futures=True)
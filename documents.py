@@ -0,0 +1,135 @@
+# documents.py
+"""Map-reduce over uploaded documents too large to send whole.
+
+Text parts over DOC_THRESHOLD_TOKENS are split into token chunks, each chunk
+is condensed into notes by a cheaper model of the same provider (map, in
+parallel), and the notes replace the document in the user message so the
+selected model answers from them (reduce). Chunk notes are cached by chunk
+content, so re-sending the same upload with a follow-up question reuses them.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from cache import cache_key
+from models import MODEL_IMAGES, MODEL_OPTIONS, MODEL_PRICING
+from pipeline import complete
+from prompt import PROMPTS
+from utils import get_encoding, provider_for, text_lru_cache
+
+DOC_THRESHOLD_TOKENS = int(os.getenv("CHATTERLIT_DOC_THRESHOLD_TOKENS", "32000"))
+DOC_CHUNK_TOKENS = int(os.getenv("CHATTERLIT_DOC_CHUNK_TOKENS", "8000"))
+DOC_CHUNK_OVERLAP = int(os.getenv("CHATTERLIT_DOC_CHUNK_OVERLAP", "200"))
+DOC_PARALLELISM = int(os.getenv("CHATTERLIT_DOC_PARALLELISM", "4"))
+# Defaults to the cheapest chat model of the selected model's provider
+DOC_MAP_MODEL = os.getenv("CHATTERLIT_DOC_MAP_MODEL", "")
+# Notes of notes are taken at most this many times
+DOC_MAX_ROUNDS = 3
+# Rough characters per token when no tokenizer is available
+CHARS_PER_TOKEN = 4
+
+
+def map_model_for(model):
+    if DOC_MAP_MODEL:
+        return DOC_MAP_MODEL
+    provider = provider_for(model)[0]
+    candidates = [
+        m for m in MODEL_OPTIONS
+        if m in MODEL_PRICING and m not in MODEL_IMAGES and provider_for(m)[0] == provider
+    ]
+    return min(candidates, key=lambda m: MODEL_PRICING[m][0], default=model)
+
+
+def _encoding(model):
+    try:
+        return get_encoding(model)
+    except Exception:
+        return None
+
+
+@text_lru_cache(maxsize=64)
+def text_tokens(text, model):
+    encoding = _encoding(model)
+    return len(encoding.encode(text, disallowed_special=())) if encoding else len(text) // CHARS_PER_TOKEN
+
+
+def chunk_text(text, model, chunk_tokens=DOC_CHUNK_TOKENS, overlap=DOC_CHUNK_OVERLAP):
+    """Split text into chunks of at most chunk_tokens, overlapping by `overlap` tokens."""
+    step = max(chunk_tokens - overlap, 1)
+    encoding = _encoding(model)
+    if encoding is None:
+        size, step = chunk_tokens * CHARS_PER_TOKEN, step * CHARS_PER_TOKEN
+        return [text[i:i + size] for i in range(0, max(len(text) - overlap * CHARS_PER_TOKEN, 1), step)]
+    tokens = encoding.encode(text, disallowed_special=())
+    return [encoding.decode(tokens[i:i + chunk_tokens]) for i in range(0, max(len(tokens) - overlap, 1), step)]
+
+
+def map_chunks(client, model, chunks, username=None, cache=None, progress=None):
+    """Notes for every chunk, in order.
+
+    Chunks run on up to DOC_PARALLELISM threads (all still admitted by the
+    provider scheduler). progress(done, total) is called from the calling
+    thread as chunks finish, so it may update Streamlit elements.
+    """
+    notes = [None] * len(chunks)
+
+    def run(i, chunk):
+        key = cache_key("document", model, PROMPTS["document"], chunk)
+        if cache is not None and (hit := cache.get(key)) is not None:
+            return i, hit
+        packed = [{"role": "system", "content": PROMPTS["document"]}, {"role": "user", "content": chunk}]
+        reply, _ = complete(client, model, packed, username, kind="map")
+        if cache is not None:
+            cache.put(key, reply)
+        return i, reply
+
+    with ThreadPoolExecutor(max_workers=DOC_PARALLELISM, thread_name_prefix="chatterlit-map") as executor:
+        futures = [executor.submit(run, i, chunk) for i, chunk in enumerate(chunks)]
+        try:
+            for done, future in enumerate(as_completed(futures), 1):
+                i, text = future.result()
+                notes[i] = text
+                if progress is not None:
+                    progress(done, len(chunks))
+        except BaseException:
+            # The run has failed: don't start (and pay for) the chunks still queued
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+    return notes
+
+
+def condense(text, client, model, username=None, cache=None, progress=None):
+    """Map text to notes, repeating on the notes until they fit DOC_THRESHOLD_TOKENS."""
+    rounds = 0
+    while rounds < DOC_MAX_ROUNDS and text_tokens(text, model) > DOC_THRESHOLD_TOKENS:
+        chunks = chunk_text(text, model)
+        if rounds and len(chunks) == 1:
+            break  # the notes no longer shrink
+        notes = map_chunks(client, model, chunks, username, cache, progress)
+        text = "\n\n".join(f"[Part {i + 1}/{len(notes)}]\n{note}" for i, note in enumerate(notes))
+        rounds += 1
+    return text
+
+
+def large_parts(message, model):
+    """Indexes of the upload text parts over DOC_THRESHOLD_TOKENS (the first text part is the prompt)."""
+    if not isinstance(message["content"], list):
+        return []
+    return [
+        i for i, part in enumerate(message["content"]) if i > 0
+        and part["type"] == "text" and text_tokens(part["text"], model) > DOC_THRESHOLD_TOKENS
+    ]
+
+
+def condense_message(message, client, model, username=None, cache=None, progress=None):
+    """Replace large text parts of a user message with their notes; returns the count replaced."""
+    # Parts are replaced, not edited: they are shared with the upload memo in uploads.py
+    content = message["content"]
+    indexes = large_parts(message, model)
+    for i in indexes:
+        text = content[i]["text"]
+        notes = condense(text, client, model, username, cache, progress)
+        content[i] = {
+            "type": "text",
+            "text": f"[Notes on an uploaded document of {text_tokens(text, model)} tokens, condensed by {model}]\n\n{notes}",
+        }
+    return len(indexes)
@@ -0,0 +1,157 @@
+# history.py
+import hashlib
+import json
+
+from blobs import materialize
+from models import (
+    MODEL_CONTEXT, DEFAULT_CONTEXT, MODEL_OUTPUT_RESERVE, DEFAULT_OUTPUT_RESERVE, HISTORY_WINDOW_TOKENS,
+    SUMMARY_RESERVE_TOKENS,
+)
+from utils import count_tokens
+
+HISTORY_MODES = ["full", "windowed", "summarized"]
+
+IMAGE_PLACEHOLDER = {"type": "text", "text": "[image omitted]"}
+
+
+def output_reserve(model):
+    for prefix, reserve in MODEL_OUTPUT_RESERVE.items():
+        if model.startswith(prefix):
+            return reserve
+    return DEFAULT_OUTPUT_RESERVE
+
+
+def history_budget(model, mode):
+    # Input budget: the context window minus room for the reply
+    context = MODEL_CONTEXT.get(model, DEFAULT_CONTEXT) - output_reserve(model)
+    if mode == "full":
+        return context
+    return min(context, HISTORY_WINDOW_TOKENS)
+
+
+def _strip_images(msg):
+    # Older turns keep their text but not their base64 image payloads
+    if not isinstance(msg["content"], list):
+        return msg
+    content = [IMAGE_PLACEHOLDER if part["type"] in ("image_url", "image_ref") else part for part in msg["content"]]
+    return {"role": msg["role"], "content": content}
+
+
+def _wire_message(msg):
+    if msg.get("is_image"):
+        # Generated images cannot be sent back to a chat model
+        return {"role": msg["role"], "content": "[generated image]"}
+    return {"role": msg["role"], "content": msg["content"]}
+
+
+def _prefix_keys(messages):
+    # Rolling hash: keys[k] identifies messages[:k + 1]
+    keys, key = [], ""
+    for msg in messages:
+        key = hashlib.sha256((key + json.dumps(msg, sort_keys=True, default=str)).encode()).hexdigest()
+        keys.append(key)
+    return keys
+
+
+def _summarize_span(span, summarize, summaries):
+    # Reuse the summary of the longest already-summarized prefix and only fold in the rest
+    keys = _prefix_keys(span)
+    if keys[-1] in summaries:
+        return summaries[keys[-1]]
+    start, previous = 0, None
+    for k in range(len(keys) - 2, -1, -1):
+        if keys[k] in summaries:
+            start, previous = k + 1, summaries[keys[k]]
+            break
+    rest = span[start:]
+    if previous is not None:
+        rest = [{"role": "system", "content": "Summary of the earlier conversation:\n" + previous}] + rest
+    summaries[keys[-1]] = summarize(rest)
+    return summaries[keys[-1]]
+
+
+def _tokens(msg, model):
+    try:
+        return count_tokens(msg, model)
+    except Exception:
+        return 0
+
+
+def materialize_messages(messages):
+    # Blob references become base64 data URLs only for what is actually sent
+    return [{"role": msg["role"], "content": materialize(msg["content"])} for msg in messages]
+
+
+def pack_messages(messages, model, mode="full", summarize=None, summaries=None, system=None):
+    """Fit the message history into the model's input budget.
+
+    Returns (packed_messages, info) where info reports the original and sent
+    token counts. In every mode the history is cut to the model's context
+    window minus its output reserve; "windowed" and "summarized" additionally
+    cap it at HISTORY_WINDOW_TOKENS and drop image parts from all but the
+    latest message. In "summarized" mode the dropped span is replaced by a
+    system message produced by `summarize(span)` and cached in `summaries` by
+    the span's hash, so a growing span only summarizes the newly dropped
+    turns. The summary counts against the same budget.
+
+    A non-empty `system` prompt is always sent first, ahead of any summary,
+    so the request prefix stays stable for provider prompt caching.
+
+    Images stay as blob references; pass the result through
+    materialize_messages() to build the API payload.
+    """
+    wire = [_wire_message(msg) for msg in messages]
+    original = sum(_tokens(msg, model) for msg in wire)
+
+    if mode != "full" and wire:
+        wire = [_strip_images(msg) for msg in wire[:-1]] + [wire[-1]]
+
+    prefix = [{"role": "system", "content": system}] if system else []
+    prefix_tokens = sum(_tokens(msg, model) for msg in prefix)
+
+    budget = history_budget(model, mode) - prefix_tokens
+    summarizing = mode == "summarized" and summarize is not None
+    # Leave room for the summary message that replaces the dropped span
+    window = budget - SUMMARY_RESERVE_TOKENS if summarizing else budget
+    kept, used = [], 0
+    for msg in reversed(wire):
+        tokens = _tokens(msg, model)
+        # The latest message is always sent
+        if kept and used + tokens > window:
+            break
+        kept.append(msg)
+        used += tokens
+    kept.reverse()
+
+    def trim(limit):
+        # Drop the oldest kept turns over `limit`; don't open on a dangling assistant reply
+        nonlocal used
+        while len(kept) > 1 and (used > limit or kept[0]["role"] != "user"):
+            used -= _tokens(kept.pop(0), model)
+
+    trim(window)
+    dropped = wire[:len(wire) - len(kept)]
+    if dropped and summarizing:
+        summaries = summaries if summaries is not None else {}
+        text = _summarize_span(dropped, summarize, summaries)
+        summary = {"role": "system", "content": "Summary of the earlier conversation:\n" + text}
+        summary_tokens = _tokens(summary, model)
+        if used + summary_tokens > budget:
+            # The summary outgrew its reserve: fold more turns into it (incrementally, the
+            # dropped span's summary is cached) and cut whatever still doesn't fit
+            trim(budget - summary_tokens)
+            dropped = wire[:len(wire) - len(kept)]
+            text = _summarize_span(dropped, summarize, summaries)
+            summary = {"role": "system", "content": "Summary of the earlier conversation:\n" + text}
+            summary_tokens = _tokens(summary, model)
+            trim(budget - summary_tokens)
+            dropped = wire[:len(wire) - len(kept)]
+        kept.insert(0, summary)
+        used += summary_tokens
+
+    kept = prefix + kept
+    used += prefix_tokens
+    original += prefix_tokens
+
+    info = {"original": original, "sent": used, "saved": max(original - used, 0), "dropped": len(dropped)}
+    return kept, info
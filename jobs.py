@@ -0,0 +1,107 @@
+# jobs.py
+import base64
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from blobs import get_blob_store, image_ref
+from scheduler import admit
+from telemetry import track
+
+JOB_WORKERS = int(os.getenv("CHATTERLIT_JOB_WORKERS", "8"))
+JOB_USER_CONCURRENCY = int(os.getenv("CHATTERLIT_IMAGE_CONCURRENCY", "2"))
+# Jobs still running after this long (e.g. lost in a restart) are reported as failed
+JOB_TIMEOUT = float(os.getenv("CHATTERLIT_JOB_TIMEOUT", "600"))
+
+IMAGE_SIZES = ["1536x1024", "1024x1024", "1024x1536", "auto"]
+
+
+class JobManager:
+    """Runs background jobs on a thread pool with a per-user concurrency cap.
+
+    Job status and results are written to the session store, so the UI (or
+    another process) only needs the job id to poll for completion. Jobs over
+    a user's limit wait in that user's queue until one of theirs finishes.
+    """
+
+    def __init__(self, store, max_workers=JOB_WORKERS, per_user=JOB_USER_CONCURRENCY):
+        self.store = store
+        self.per_user = per_user
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chatterlit-job")
+        self.lock = threading.Lock()
+        self.running = defaultdict(int)
+        self.pending = defaultdict(deque)
+
+    def submit(self, username, fn, *args):
+        job_id = uuid.uuid4().hex
+        self.store.set_job(username, job_id, "queued")
+        with self.lock:
+            self.pending[username].append((job_id, fn, args))
+        self._dispatch(username)
+        return job_id
+
+    def _dispatch(self, username):
+        with self.lock:
+            while self.pending[username] and self.running[username] < self.per_user:
+                job_id, fn, args = self.pending[username].popleft()
+                self.running[username] += 1
+                self.executor.submit(self._run, username, job_id, fn, args)
+
+    def _run(self, username, job_id, fn, args):
+        try:
+            self.store.set_job(username, job_id, "running")
+            self.store.set_job(username, job_id, "done", result=fn(*args))
+        except Exception as e:
+            self.store.set_job(username, job_id, "error", error=str(e))
+        finally:
+            with self.lock:
+                self.running[username] -= 1
+            self._dispatch(username)
+
+
+def generate_images(client, model, prompt, n, size, cache=None, key=None, username=None):
+    # Runs on a worker thread: no Streamlit calls here
+    with admit(model, username) as lease, track("image", model, username, {"prompt": prompt, "n": n, "size": size}) as event:
+        response = lease.call(client.images.generate, model=model, prompt=prompt, n=n, size=size)
+        event.update({"images": n, "size": size})
+    blobs = get_blob_store()
+    images = [image_ref(blobs.put(base64.b64decode(item.b64_json)), "image/png") for item in response.data]
+    if cache is not None:
+        cache.put(key, images)
+    return images
+
+
+def resolve_jobs(store, message):
+    """Fill an image message's content from its jobs; returns the pending statuses.
+
+    Images that were served from the response cache are kept in
+    message["images"] and come first. Job records are written before the
+    message that references them, so a missing record has expired.
+    """
+    jobs = store.get_jobs(message.get("jobs", []))
+    content, pending, errors = list(message.get("images", [])), [], []
+    for job_id in message.get("jobs", []):
+        job = jobs.get(job_id)
+        if job is None:
+            errors.append("Image job expired before its result was saved.")
+        elif job["status"] == "done":
+            content.extend(job["result"])
+        elif job["status"] == "error":
+            errors.append(job["error"])
+        elif time.time() - job["updated"] > JOB_TIMEOUT:
+            errors.append("Image generation did not finish.")
+        else:
+            pending.append(job["status"])
+    message["content"] = content
+    message["errors"] = errors
+    return pending
+
+
+def finish_image_message(message):
+    """Fold finished jobs into the message so it no longer depends on job records."""
+    message.pop("images", None)
+    message.pop("jobs", None)
+    return message
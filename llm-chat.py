@@ -14,28 +14,45 @@ Features:
 - Model selection and options in the sidebar (sidecar area)
 - File upload support (images / tex / txt)
 - Token counting and per-message display
-- Image generation support for image-capable models
-- Preserves original message structure and session persistence
+- Image generation for image-capable models as background jobs (jobs.py)
+- Preserves original message structure; sessions persist on disk (store.py)
 
 Note: This code expects the same helper modules/constants used
 in the original Chatterlite code to be available:
-  - utils: get_content, truncate_message, init_client, count_tokens, process_uploaded_files
+  - utils: get_content, truncate_message, init_client, process_uploaded_files
+  - pipeline: build_user_message, prepare, image_prompt (shared with batch.py)
   - models: MODEL_OPTIONS, MODEL_IMAGES
   - prompt: PROMPTS
   - auth.config.yml file for streamlit_authenticator
 """
 import os
+import time
+import uuid
+from contextlib import closing
 from datetime import datetime
 
+import threading
+
 import streamlit as st
-import pandas as pd
-import base64
 import yaml
 from yaml.loader import SafeLoader
 import streamlit_authenticator as stauth
 
-from utils import get_content, truncate_message, init_client, count_tokens, process_uploaded_files
+from utils import get_content, truncate_message, init_client
+from utils import extract_reply, stream_reply, format_stats, estimate_cost, usage_stats, message_token_counts, get_encoding, connection_stats
+from utils import prewarm_encodings, provider_for
 from models import MODEL_OPTIONS, MODEL_IMAGES
+from history import HISTORY_MODES, materialize_messages
+from pipeline import build_user_message, prepare, image_prompt, client_for
+from documents import condense_message, large_parts, map_model_for, DOC_THRESHOLD_TOKENS
+from uploads import MAX_TEXT_BYTES, MAX_DOCUMENT_BYTES
+from cache import cache_key, open_cache, CacheMapping
+from store import open_store
+from blobs import get_blob_store
+from compare import fan_out
+from telemetry import track, aggregates, prometheus_text, TRACKED_STATS
+from scheduler import admit, scheduler_stats
+from jobs import JobManager, IMAGE_SIZES, JOB_TIMEOUT, generate_images, resolve_jobs, finish_image_message
 from prompt import PROMPTS
 
 # -------------------------
@@ -44,9 +61,28 @@ from prompt import PROMPTS
 st.set_page_config(page_title="Chatterlite", layout="wide")
 st.title("Chatterlite")
 
-with open('./auth.config.yml') as file:
-    config = yaml.load(file, Loader=SafeLoader)
+AUTH_CONFIG = './auth.config.yml'
+
+@st.cache_resource
+def load_auth_config(path, mtime):
+    # Parsed once per file version; Authenticate hashes plaintext passwords in
+    # place, so sharing the dict means bcrypt runs once instead of every rerun
+    with open(path) as file:
+        return yaml.load(file, Loader=SafeLoader)
+
+@st.cache_resource
+def prewarm():
+    # Server start: load tokenizer encodings and the OpenAI SDK in the background
+    def run():
+        prewarm_encodings([m for m in MODEL_OPTIONS if m not in MODEL_IMAGES])
+        import openai  # noqa: F401
+    threading.Thread(target=run, daemon=True).start()
+
+prewarm()
+config = load_auth_config(AUTH_CONFIG, os.path.getmtime(AUTH_CONFIG))
 
+# Constructed every run: it renders the cookie component, and with the
+# cached (already hashed) credentials it only takes about a millisecond
 authenticator = stauth.Authenticate(
     config['credentials'],
     config['cookie']['name'],
@@ -69,16 +105,35 @@ elif st.session_state.get('authentication_status') is None:
 # -------------------------
 # Session management (vLLM style)
 # -------------------------
-if "sessions" not in st.session_state:
-    st.session_state.sessions = {}  # mapping session_id -> messages list
+@st.cache_resource
+def get_store():
+    # One process-wide store shared by every browser session
+    return open_store()
+
+@st.cache_resource
+def get_job_manager():
+    return JobManager(get_store())
+
+@st.cache_resource
+def get_response_cache():
+    return open_cache()
+
+store = get_store()
+job_manager = get_job_manager()
+response_cache = get_response_cache()
+username = st.session_state.get("username")
 
 if "current_session" not in st.session_state:
     st.session_state.current_session = None
 
 if "messages" not in st.session_state:
-    # messages is the active session's message list.
+    # messages is the active session's message list; other sessions stay on disk.
     st.session_state.messages = []
 
+# When messages was last read from or written to the store
+if "loaded_at" not in st.session_state:
+    st.session_state.loaded_at = 0.0
+
 if "active_session" not in st.session_state:
     st.session_state.active_session = None
 
@@ -90,32 +145,74 @@ if "generating" not in st.session_state:
 if "show_reasoning" not in st.session_state:
     st.session_state.show_reasoning = {}
 
+# Summaries of dropped history spans (span hash -> summary text) live in the
+# response cache, so every session and replica can reuse them
+summaries = CacheMapping(response_cache, "summary")
+
+# History window size per session
+if "history_shown" not in st.session_state:
+    st.session_state.history_shown = {}
+# (session_id, message index) of the search result being viewed
+if "focus_message" not in st.session_state:
+    st.session_state.focus_message = None
+
+# Per-message token counts keyed by (session_id, encoding name)
+if "token_counts" not in st.session_state:
+    st.session_state.token_counts = {}
+
 # -------------------------
 # Helper session functions
 # -------------------------
 def create_new_chat_session():
-    session_id = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    st.session_state.sessions[session_id] = []
+    # The session is written to the store with its first message
+    now = datetime.now()
+    session_id = now.strftime("%Y-%m-%d %H:%M:%S")
+    if session_id == st.session_state.current_session:
+        # "New Session" clicked within a second of opening the current one
+        session_id = now.strftime("%Y-%m-%d %H:%M:%S.%f")
     st.session_state.current_session = session_id
     st.session_state.active_session = session_id
     st.session_state.messages = []
+    st.session_state.focus_message = None
+    store.set_state(username, "current_session", session_id)
 
 def switch_to_chat_session(session_id):
     st.session_state.current_session = session_id
     st.session_state.active_session = session_id
-    st.session_state.messages = st.session_state.sessions.get(session_id, [])
-
-# Initialize first session if none exists
+    st.session_state.messages = store.load_messages(username, session_id)
+    st.session_state.loaded_at = time.time()
+    st.session_state.focus_message = None
+    store.set_state(username, "current_session", session_id)
+
+def jump_to_message(session_id, seq):
+    switch_to_chat_session(session_id)
+    st.session_state.focus_message = (session_id, seq)
+
+def append_message(message):
+    st.session_state.messages.append(message)
+    store.append_message(username, st.session_state.current_session, message)
+    st.session_state.loaded_at = time.time()
+
+def update_message(index, message):
+    store.update_message(username, st.session_state.active_session, index, message)
+    # Token counts assume append-only messages; recount from the rewritten one
+    for (session_id, _), counts in st.session_state.token_counts.items():
+        if session_id == st.session_state.active_session:
+            del counts[index:]
+
+# A new browser session reopens the user's last session, whichever replica it was on
 if st.session_state.current_session is None:
-    create_new_chat_session()
-    st.session_state.active_session = st.session_state.current_session
+    if last_session := store.get_state(username, "current_session"):
+        switch_to_chat_session(last_session)
+    else:
+        create_new_chat_session()
 
 # -------------------------
 # Sidebar / Model selection (acts as "sidecar")
 # -------------------------
 st.sidebar.title("Model & Options")
 
-# Show models table in an expander
+# Show models table in an expander (import pandas as pd here if re-enabled)
 # with st.sidebar.expander("See all available models and their descriptions", expanded=False):
 #     st.table(pd.DataFrame(MODEL_OPTIONS.items(), columns=["Model Name", "Description"]))
 
@@ -126,22 +223,74 @@ selected_model = st.sidebar.selectbox("Select Model", model_names, index=default
 
 # Option toggles
 include_short = st.sidebar.checkbox("Shorter", value=False, help="Generate a short answer instead of a detailed one.")
-# include_history = st.sidebar.checkbox("History", value=True, help="Include previous messages in the chat history for context.")
+history_mode = st.sidebar.selectbox(
+    "History", HISTORY_MODES, index=0,
+    help="full: send all previous messages (up to the model's context limit); windowed: send only the most recent turns; summarized: replace older turns with a summary.",
+)
 include_interactive = st.sidebar.checkbox("Interactive", value=False, help="Wait for user input after each response.")
 include_jobs = st.sidebar.checkbox("Jobs", value=False, help="Adjust job titles to better fit the job description.")
 include_image = st.sidebar.checkbox("Infographic", value=True, help="Create an infographic from the text.")
 include_code_block = st.sidebar.checkbox("Code Block", value=False, help="Add a code block to the response.")
+stream_output = st.sidebar.checkbox("Stream", value=True, help="Render the response as it is generated.")
+use_cache = st.sidebar.checkbox("Use cache", value=True, help="Reuse stored answers for identical requests. Turn off to always call the model.")
+if selected_model not in MODEL_IMAGES:
+    large_documents = st.sidebar.checkbox(
+        "Large documents", value=False,
+        help=f"Text uploads over {DOC_THRESHOLD_TOKENS} tokens are condensed chunk by chunk with "
+             f"{map_model_for(selected_model)}, and {selected_model} answers from the notes. Text is read up to "
+             f"{MAX_DOCUMENT_BYTES // (1024 * 1024)} MB instead of {MAX_TEXT_BYTES // (1024 * 1024)} MB.",
+    )
+    compare_models = st.sidebar.multiselect(
+        "Compare with", [m for m in model_names if m not in MODEL_IMAGES and m != selected_model],
+        help="Send the same prompt to these models in parallel and stream the answers side by side.",
+    )
+else:
+    large_documents = False
+    compare_models = []
+    image_sizes = st.sidebar.multiselect(
+        "Image sizes", IMAGE_SIZES, default=IMAGE_SIZES[:1],
+        help="Each size is generated as a separate background job.",
+    )
+    image_count = st.sidebar.number_input("Images per size", min_value=1, max_value=4, value=1)
 
 st.sidebar.divider()
 # st.sidebar.title("Chat Sessions")
-# if st.sidebar.button("New Session"):
-#     create_new_chat_session()
-
-# Display all sessions in the sidebar in reverse chronological order
-for session_id in sorted(st.session_state.sessions.keys(), reverse=True):
+# New browser sessions reopen the last session, so starting a fresh one is explicit
+st.sidebar.button("New Session", key="new_session", on_click=create_new_chat_session)
+
+# Full-text search over the user's past messages; a result opens its session at that turn
+search_query = st.sidebar.text_input("Search sessions", key="session_search", placeholder="Search past messages")
+if search_query:
+    hits = store.search(username, search_query)
+    if not hits:
+        st.sidebar.caption("No matches.")
+    for hit in hits:
+        snippet = " ".join(hit["snippet"].split())
+        st.sidebar.button(
+            f"{hit['session_id']} · {hit['role']}: {snippet}",
+            key=f"search_hit_{hit['session_id']}_{hit['seq']}",
+            on_click=jump_to_message,
+            args=(hit["session_id"], hit["seq"]),
+        )
+    st.sidebar.divider()
+
+# Display all sessions in the sidebar in reverse chronological order.
+# Only the session index (ids and titles) is read here, not message bodies.
+session_index = store.list_sessions(username)
+# Reload the open session if another tab or replica appended to it since
+open_session = next((s for s in session_index if s["session_id"] == st.session_state.current_session), None)
+if open_session and open_session["updated"] > st.session_state.loaded_at:
+    st.session_state.messages = store.load_messages(username, open_session["session_id"])
+    st.session_state.loaded_at = time.time()
+if st.session_state.current_session not in {s["session_id"] for s in session_index}:
+    session_index.insert(0, {"session_id": st.session_state.current_session, "title": ""})
+
+for session in session_index:
+    session_id = session["session_id"]
+    label = f"{session_id} · {session['title']}" if session["title"] else session_id
     if session_id == st.session_state.active_session:
         st.sidebar.button(
-            f"📍 {session_id}",
+            f"📍 {label}",
             key=f"session_pin_{session_id}",
             type="primary",
             on_click=switch_to_chat_session,
@@ -149,7 +298,7 @@ for session_id in sorted(st.session_state.sessions.keys(), reverse=True):
         )
     else:
         st.sidebar.button(
-            f"Session {session_id}",
+            f"Session {label}",
             key=f"session_btn_{session_id}",
             on_click=switch_to_chat_session,
             args=(session_id,),
@@ -160,108 +309,91 @@ for session_id in sorted(st.session_state.sessions.keys(), reverse=True):
 # -------------------------
 client = init_client(selected_model)
 
+conn = connection_stats()
+st.sidebar.caption(
+    f"Connections: {conn['connections_opened']} new / {conn['connections_reused']} reused, "
+    f"clients: {conn['clients_created']} created / {conn['clients_reused']} reused"
+)
+
+# -------------------------
+# Admin: request telemetry (roles from auth.config.yml)
+# -------------------------
+roles = st.session_state.get("roles") or config["credentials"]["usernames"].get(username, {}).get("roles") or []
+if "admin" in roles and st.sidebar.checkbox("Telemetry", value=False, help="Admin only: request latency and token aggregates."):
+    st.subheader("Request telemetry")
+    st.dataframe(aggregates())
+    st.caption("Provider scheduler")
+    st.dataframe(scheduler_stats())
+    st.download_button("Prometheus metrics", prometheus_text(), file_name="chatterlit.prom", mime="text/plain")
+    st.markdown("---")
+
 # -------------------------
 # Main UI - message display and input
 # -------------------------
 # Show active model at top of page
 st.markdown(f"**Model:** {selected_model}")
 
-# Uploaded files / images
-uploaded_files = st.file_uploader("Files/Images", type=["tex", "png", "jpg", "jpeg", "txt"], accept_multiple_files=True)
-
-# Chat input
-prompt = st.chat_input("You:")
-text_piece = None
+@st.fragment
+def input_area():
+    # Uploads rerun only this fragment; a submitted prompt is handed to a full app run
+    st.file_uploader("Files/Images", type=["tex", "png", "jpg", "jpeg", "txt"], accept_multiple_files=True, key="uploads")
+    if submitted := st.chat_input("You:"):
+        st.session_state.pending_prompt = submitted
+        st.rerun()
+
+input_area()
+uploaded_files = st.session_state.get("uploads") or []
+prompt = st.session_state.pop("pending_prompt", None)
+
+# Compared models may use another provider; check their keys before the prompt is persisted
+missing_keys = sorted({provider_for(m)[1] for m in compare_models if not os.getenv(provider_for(m)[1])})
+if prompt and missing_keys:
+    st.error(f"{', '.join(missing_keys)} not set; remove those models from 'Compare with'.")
+    prompt = None
+
+# In-flight replies are recorded per session in the store, so another tab or replica can say so
+in_flight = store.get_state(username, f"generating:{st.session_state.active_session}")
+if (
+    not prompt and in_flight
+    and st.session_state.messages and st.session_state.messages[-1]["role"] == "user"
+    and time.time() - in_flight["started"] < JOB_TIMEOUT
+):
+    st.info("A reply for this session is still being generated in another window; rerun to see it.")
 
 # When user submits a message
 if prompt:
-    st.session_state.generating = True
-
-    # Build the message content in the same shape as the original Chatterlite expects
-    # text content is built from the prompt + options/prompts
-    if include_image:
-        text_piece = PROMPTS["image"] + prompt
-
-    if text_piece is None:
-        text_piece = prompt
-
-    if include_short:
-        text_piece = text_piece + " short answer."
-    if include_interactive:
-        text_piece = text_piece + PROMPTS["interactive"]
-    if include_jobs:
-        text_piece = text_piece + PROMPTS["jobs"]
-    if include_code_block:
-        text_piece = text_piece + PROMPTS["code_block"]
-    
-    content = [{"type": "text", "text": text_piece}] + process_uploaded_files(uploaded_files)
-
-    # Update messages list depending on include_history
-    st.session_state.messages = st.session_state.messages + [{"role": "user", "content": content}]
-    
-    # Persist session messages into sessions store
-    st.session_state.sessions[st.session_state.current_session] = st.session_state.messages
-
-    # Echo the user message in the UI
-    # with st.chat_message("user"):
-    #     # get_content knows how to render the structured content
-    #     st.markdown(get_content(st.session_state.messages[-1]), unsafe_allow_html=True)
-
-    # Generate assistant reply (image or text)
-    if selected_model not in MODEL_IMAGES:
-        with st.spinner("Generating response..."):
+    # The user message holds only the prompt and uploads; option prompts are
+    # sent as a stable system prefix (prompt.system_prompt) when the request is built
+    user_message = build_user_message(
+        prompt, uploaded_files, selected_model, MAX_DOCUMENT_BYTES if large_documents else None,
+    )
+    map_model = map_model_for(selected_model)
+    if large_documents and large_parts(user_message, map_model):
+        # Map: chunk notes from the cheaper model (cached per chunk); reduce: the reply below
+        with st.status(f"Reading large documents with {map_model}...") as doc_status:
+            doc_progress = st.progress(0.0)
             try:
-                # The original client usage expected messages in their structured format,
-                # we pass the session messages as-is.
-                response = client.chat.completions.create(
-                    model=selected_model,
-                    messages=st.session_state.messages
+                condensed = condense_message(
+                    user_message, client_for(map_model), map_model, username, response_cache,
+                    lambda done, total: doc_progress.progress(done / total, text=f"Part {done} of {total}"),
                 )
-                # Extract text content; adjust depending on client return shape
-                reply_text = None
-                # Try common shapes
-                if hasattr(response, "choices"):
-                    choice = response.choices[0]
-                    # Some clients return message.content as attribute
-                    if hasattr(choice, "message") and hasattr(choice.message, "content"):
-                        reply_text = choice.message.content
-                    # Or choices[0].text
-                    elif hasattr(choice, "text"):
-                        reply_text = choice.text
-                # Fallback
-                if reply_text is None:
-                    # try dictionary-like access
-                    try:
-                        reply_text = response["choices"][0]["message"]["content"]
-                    except Exception:
-                        reply_text = str(response)
+                doc_status.update(label=f"Condensed {condensed} document(s) with {map_model}", state="complete", expanded=False)
             except Exception as e:
-                reply_text = f"Error: {e}"
-
-        # Append assistant message
-        st.session_state.messages.append({"role": "assistant", "content": reply_text})
-        st.session_state.sessions[st.session_state.current_session] = st.session_state.messages
-
-        # # Display assistant answer
-        # with st.chat_message("assistant"):
-        #     st.markdown(reply_text, unsafe_allow_html=True)
-    else:
-        # Image generation path
-        with st.spinner("Generating image..."):
-            latest_message_text = st.session_state.messages[-1]["content"][0]["text"]
-            response = client.images.generate(
-                model=selected_model, prompt=latest_message_text, n=1, size="1024x1024"
-            )
-            image_b64 = response.data[0].b64_json
-            image_bytes = base64.b64decode(image_b64)
-
-        st.session_state.messages.append({"role": "assistant", "content": image_bytes, "is_image": True})
-        st.session_state.sessions[st.session_state.current_session] = st.session_state.messages
+                # Nothing is persisted: the prompt can be sent again once the map model is reachable
+                doc_status.update(label=f"Could not condense the documents: {e}", state="error")
+                prompt = None
 
-        # with st.chat_message("assistant"):
-        #     st.image(image_bytes)
+if prompt:
+    option_flags = {
+        "short": include_short, "interactive": include_interactive, "jobs": include_jobs,
+        "image": include_image, "code_block": include_code_block, "history": history_mode,
+    }
 
-    st.session_state.generating = False
+    # Persist the user message; the first one also titles the session
+    is_first = not st.session_state.messages
+    append_message(user_message)
+    if is_first:
+        store.set_title(username, st.session_state.current_session, truncate_message(prompt, 40))
 
 # -------------------------
 # Display chat history for active session
@@ -269,40 +401,283 @@ if prompt:
 st.markdown("---")
 # st.header("Conversation")
 
-total_tokens = 0
-for i, msg in enumerate(st.session_state.messages):
-    # Count tokens for this message
+@st.cache_data(max_entries=64, show_spinner=False)
+def blob_bytes(digest):
+    # Blobs are immutable, so rerenders don't need to go back to disk
+    return get_blob_store().read(digest)
+
+def render_image(content, **kwargs):
+    # Image messages reference the blob store; older sessions may hold raw bytes
+    if isinstance(content, list):
+        for part in content:
+            render_image(part, **kwargs)
+    elif isinstance(content, dict) and content.get("type") == "image_ref":
+        st.image(blob_bytes(content["blob"]), **kwargs)
+    else:
+        st.image(content, **kwargs)
+
+@st.fragment(run_every=2)
+def image_job_status(msg):
+    # Polls only this fragment until the jobs finish, then reruns the whole app
+    pending = resolve_jobs(store, msg)
+    if pending:
+        st.info(f"Generating images: {', '.join(pending)}")
+    else:
+        st.rerun()
+
+def render_assistant(msg, index):
+    # Assistant content can be simple text, or structured, or images
+    if not msg.get("is_image"):
+        st.markdown(msg["content"], unsafe_allow_html=True)
+        if msg.get("compare"):
+            st.caption(f"Compared with {msg.get('model', 'the selected model')}:")
+            for column, alt in zip(st.columns(len(msg["compare"])), msg["compare"]):
+                column.markdown(f"**{alt['model']}**")
+                column.caption(format_stats(alt["stats"]))
+                column.markdown(alt["content"], unsafe_allow_html=True)
+        return
+    if msg.get("jobs"):
+        if resolve_jobs(store, msg):
+            image_job_status(msg)
+            return
+        # Job records expire; the session history keeps the results itself
+        update_message(index, finish_image_message(msg))
+    render_image(msg["content"])
+    for error in msg.get("errors", []):
+        st.error(error)
+
+# Messages rendered eagerly; older ones are loaded a page at a time
+HISTORY_PAGE = int(os.getenv("CHATTERLIT_HISTORY_PAGE", "40"))
+
+def show_older_messages(count):
+    st.session_state.history_shown[st.session_state.active_session] = count
+
+@st.fragment
+def render_history():
+    # Runs as its own fragment: "Load older" and job polling don't rerun the app
+    messages = st.session_state.messages
+
+    # Token counts are cached per session and encoding; only new messages are tokenized
     try:
-        msg_tokens = count_tokens(msg, selected_model)
+        encoding_name = get_encoding(selected_model).name
     except Exception:
-        # If the token counter fails, fallback to 0
-        msg_tokens = 0
-    total_tokens += msg_tokens
-
-    if msg["role"] == "user":
-        with st.container():
-            st.markdown(f"**User ({msg_tokens} tokens, total: {total_tokens})**")
-            with st.expander("Show message", expanded=False):
-                st.markdown(get_content(msg), unsafe_allow_html=True)
-    else:
-        # Assistant messages: for every previous assistant message show it inside an expander
-        with st.container():
-            if i < len(st.session_state.messages) - 1:
-                with st.expander(f"Show response {i}", expanded=False):
-                    # Assistant content can be simple text, or structured, or bytes for images
-                    if msg.get("is_image"):
-                        st.image(msg["content"])
+        encoding_name = None
+    token_counts = st.session_state.token_counts.setdefault((st.session_state.active_session, encoding_name), [])
+    if encoding_name is not None:
+        message_token_counts(token_counts, messages, selected_model)
+
+    shown = st.session_state.history_shown.get(st.session_state.active_session, HISTORY_PAGE)
+    # A search result outside the window widens it so the matching turn is rendered
+    focus = st.session_state.focus_message
+    focus_index = focus[1] if focus and focus[0] == st.session_state.active_session else None
+    if focus_index is not None:
+        shown = max(shown, len(messages) - focus_index)
+    start = max(len(messages) - shown, 0)
+    # Start the window on a user message so Q&A pairs stay together
+    while start > 0 and messages[start]["role"] != "user":
+        start -= 1
+    if start > 0:
+        st.button(
+            f"Load older messages ({start} hidden)", key="load_older",
+            on_click=show_older_messages, args=(shown + HISTORY_PAGE,),
+        )
+
+    total_tokens = sum(token_counts[:start])
+    for i in range(start, len(messages)):
+        msg = messages[i]
+        msg_tokens = token_counts[i] if i < len(token_counts) else 0
+        total_tokens += msg_tokens
+
+        if msg["role"] == "user":
+            with st.container():
+                st.markdown(f"**User ({msg_tokens} tokens, total: {total_tokens})**")
+                with st.expander("Show message", expanded=i == focus_index):
+                    st.markdown(get_content(msg), unsafe_allow_html=True)
+                    if isinstance(msg["content"], list):
+                        for part in msg["content"]:
+                            if part["type"] == "image_ref":
+                                render_image(part, width=240)
+        else:
+            # Assistant messages: for every previous assistant message show it inside an expander
+            with st.container():
+                if msg.get("stats"):
+                    st.caption(format_stats(msg["stats"]))
+                if i < len(messages) - 1:
+                    with st.expander(f"Show response {i}", expanded=i == focus_index):
+                        render_assistant(msg, i)
+                else:
+                    # Last assistant message shown directly
+                    render_assistant(msg, i)
+
+        # Divider after each Q&A pair (user followed by assistant)
+        if i % 2 == 1:
+            st.markdown("---")
+
+render_history()
+
+# -------------------------
+# Generate assistant reply (image or text) below the history
+# -------------------------
+def queue_notice(placeholder, model):
+    # on_wait callback for the scheduler: shows where this request is in the provider queue
+    return lambda position: placeholder.caption(f"Waiting for {model} capacity: position {position} in queue")
+
+def summarize_history(span):
+    messages = span + [{"role": "user", "content": PROMPTS["summary"]}]
+    tokens = sum(message_token_counts([], messages, selected_model))
+    with admit(selected_model, username, tokens) as lease, track("summary", selected_model, username, messages) as event:
+        response = lease.call(client.chat.completions.create, model=selected_model, messages=messages)
+        if getattr(response, "usage", None) is not None:
+            event.update(usage_stats(response.usage, {}))
+            lease.used(event)
+    return extract_reply(response)
+
+if prompt:
+    # Recorded in the store so other tabs and replicas can tell a reply is on its way;
+    # cleared however the run ends (errors, st.stop, a rerun from a new prompt)
+    st.session_state.generating = True
+    generating_key = f"generating:{st.session_state.current_session}"
+    generation = {"id": uuid.uuid4().hex, "started": time.time()}
+    store.set_state(username, generating_key, generation)
+    try:
+        if selected_model not in MODEL_IMAGES and compare_models:
+            # Fan-out: the same content goes to every model concurrently, one column each
+            models = [selected_model] + compare_models
+            try:
+                columns = dict(zip(models, st.columns(len(models))))
+                placeholders, texts, results = {}, {}, {}
+                requests, keys, history_saved = [], {}, {}
+                for model, column in columns.items():
+                    column.markdown(f"**{model}**")
+                    placeholders[model] = column.empty()
+                    texts[model] = ""
+                    packed, info = prepare(
+                        st.session_state.messages, model, option_flags,
+                        summarize=summarize_history, summaries=summaries,
+                    )
+                    history_saved[model] = info["saved"]
+                    # Same key as the single-model path, so either one can reuse the other's replies
+                    keys[model] = cache_key("chat", model, packed, option_flags)
+                    cached = response_cache.get(keys[model]) if use_cache else None
+                    if cached is not None:
+                        texts[model] = cached["content"]
+                        results[model] = {**cached["stats"], "history_saved": info["saved"], "cached": True}
+                        placeholders[model].markdown(texts[model], unsafe_allow_html=True)
+                        column.caption(format_stats(results[model]))
+                        with track("compare", model, username) as event:
+                            event["cached"] = True
                     else:
-                        st.markdown(msg["content"], unsafe_allow_html=True)
+                        requests.append((model, init_client(model), materialize_messages(packed), info["sent"]))
+
+                # closing(): a stop or rerun mid-stream cancels the other models' streams
+                with closing(fan_out(requests, username)) as replies:
+                    for model, delta, stats in replies:
+                        if delta is None:
+                            stats["history_saved"] = history_saved[model]
+                            results[model] = stats
+                            columns[model].caption(format_stats(stats))
+                            if "error" not in stats:
+                                response_cache.put(keys[model], {"content": texts[model], "stats": stats})
+                        else:
+                            texts[model] += delta
+                            placeholders[model].markdown(texts[model], unsafe_allow_html=True)
+            except Exception as e:
+                reply_text = f"Error: {e}"
+                st.markdown(reply_text)
+                append_message({"role": "assistant", "content": reply_text, "model": selected_model, "stats": {}})
             else:
-                # Last assistant message shown directly
-                if msg.get("is_image"):
-                    st.image(msg["content"])
+                append_message({
+                    "role": "assistant",
+                    "content": texts[selected_model],
+                    "model": selected_model,
+                    "stats": results[selected_model],
+                    "compare": [{"model": m, "content": texts[m], "stats": results[m]} for m in compare_models],
+                })
+        elif selected_model not in MODEL_IMAGES:
+            stats = {}
+            try:
+                packed, history_info = prepare(
+                    st.session_state.messages, selected_model, option_flags,
+                    summarize=summarize_history, summaries=summaries,
+                )
+                stats["history_saved"] = history_info["saved"]
+                # Option flags are part of the key even though they are also baked into the text
+                key = cache_key("chat", selected_model, packed, option_flags)
+                cached = response_cache.get(key) if use_cache else None
+                if cached is not None:
+                    reply_text = cached["content"]
+                    stats = {**cached["stats"], "history_saved": history_info["saved"], "cached": True}
+                    st.markdown(reply_text, unsafe_allow_html=True)
+                    with track("chat", selected_model, username) as event:
+                        event["cached"] = True
                 else:
-                    st.markdown(msg["content"], unsafe_allow_html=True)
-
-    # Divider after each Q&A pair (user followed by assistant)
-    if i % 2 == 1:
-        st.markdown("---")
+                    payload = materialize_messages(packed)
+                    notice = st.empty()
+                    with admit(
+                        selected_model, username, history_info["sent"], queue_notice(notice, selected_model),
+                    ) as lease, track("chat", selected_model, username, payload) as event:
+                        notice.empty()
+                        started = time.perf_counter()
+                        if stream_output:
+                            stream = lease.call(
+                                client.chat.completions.create,
+                                model=selected_model,
+                                messages=payload,
+                                stream=True,
+                                stream_options={"include_usage": True},
+                            )
+                            # Deltas are rendered incrementally; write_stream returns the assembled text
+                            reply_text = st.write_stream(stream_reply(stream, selected_model, stats, started))
+                        else:
+                            with st.spinner("Generating response..."):
+                                response = lease.call(
+                                    client.chat.completions.create,
+                                    model=selected_model,
+                                    messages=payload
+                                )
+                                stats["elapsed"] = time.perf_counter() - started
+                            if getattr(response, "usage", None) is not None:
+                                usage_stats(response.usage, stats)
+                            reply_text = extract_reply(response)
+                            st.markdown(reply_text, unsafe_allow_html=True)
+                        lease.used(stats)
+                        stats["cost"] = estimate_cost(selected_model, stats)
+                        event.update({k: stats[k] for k in TRACKED_STATS if k in stats})
+                    response_cache.put(key, {"content": reply_text, "stats": stats})
+            except Exception as e:
+                reply_text = f"Error: {e}"
+                st.markdown(reply_text)
+
+            # Append assistant message
+            append_message({"role": "assistant", "content": reply_text, "model": selected_model, "stats": stats})
+            if stats:
+                st.caption(format_stats(stats))
+        else:
+            # Image generation path: one background job per size, the message keeps the job ids.
+            # Sizes already in the response cache are filled in directly.
+            latest_message_text = image_prompt(option_flags, st.session_state.messages[-1]["content"][0]["text"])
+            images, jobs = [], []
+            for size in (image_sizes or IMAGE_SIZES[:1]):
+                key = cache_key("image", selected_model, latest_message_text, image_count, size)
+                cached = response_cache.get(key) if use_cache else None
+                if cached is not None:
+                    images.extend(cached)
+                else:
+                    jobs.append(job_manager.submit(
+                        username, generate_images, client, selected_model, latest_message_text,
+                        image_count, size, response_cache, key, username,
+                    ))
+            append_message({
+                "role": "assistant", "content": images, "is_image": True, "images": images, "jobs": jobs,
+                "stats": {"cached": True} if images else {},
+            })
+            if images:
+                st.caption(format_stats(st.session_state.messages[-1]["stats"]))
+            render_assistant(st.session_state.messages[-1], len(st.session_state.messages) - 1)
+    finally:
+        st.session_state.generating = False
+        # Leave the marker alone if another tab has since started a reply in this session
+        if (store.get_state(username, generating_key) or {}).get("id") == generation["id"]:
+            store.set_state(username, generating_key, None)
 
 # End of file
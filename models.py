@@ -39,5 +39,91 @@ MODEL_OPTIONS = {
     # "claude-sonnet-4-0": "High intelligence and balanced performance",   
 
 
+# Total context window per model (input + output). History is packed to fit
+# the window minus the model's output reserve (MODEL_OUTPUT_RESERVE).
+MODEL_CONTEXT = {
+    "grok-4-latest": 256_000,
+
+    "gemini-3-pro-preview": 1_048_576,
+    "gemini-2.5-pro": 1_048_576,
+    "gemini-2.5-flash": 1_048_576,
+
+    "gpt-5.2": 400_000,
+    "gpt-5.1": 400_000,
+    "gpt-5": 400_000,
+    "gpt-5-mini": 400_000,
+    "gpt-5-nano": 400_000,
+    "gpt-4.1": 1_047_576,
+    "gpt-4.1-mini": 1_047_576,
+    "gpt-4.1-nano": 1_047_576,
+    "gpt-4o": 128_000,
+    "gpt-4o-mini": 128_000,
+    "gpt-4o-search-preview": 128_000,
+    "gpt-4o-mini-search-preview": 128_000,
+
+    "o4-mini": 200_000,
+    "o4-mini-deep-research": 200_000,
+    "o3": 200_000,
+    "o3-pro": 200_000,
+    "o3-deep-research": 200_000,
+    "o3-mini": 200_000,
+}
+
+DEFAULT_CONTEXT = 128_000
+
+# Tokens kept free for the reply (the provider's max output tokens; for
+# reasoning models this also covers reasoning tokens). Matched by prefix.
+MODEL_OUTPUT_RESERVE = {
+    "gemini": 65_536,
+    "gpt-5": 128_000,
+    "gpt-4.1": 32_768,
+    "gpt-4o": 16_384,
+    "o3": 100_000,
+    "o4": 100_000,
+}
+DEFAULT_OUTPUT_RESERVE = 16_384
+
+# Tokens set aside for the summary message in the "summarized" history mode
+SUMMARY_RESERVE_TOKENS = 1_000
+
+# USD per 1M (input, output) tokens, from the providers' public price lists.
+# Models missing here are compared without a cost.
+MODEL_PRICING = {
+    "grok-4-latest": (3.00, 15.00),
+
+    "gemini-3-pro-preview": (2.00, 12.00),
+    "gemini-2.5-pro": (1.25, 10.00),
+    "gemini-2.5-flash": (0.30, 2.50),
+
+    "gpt-5.2": (1.75, 14.00),
+    "gpt-5.1": (1.25, 10.00),
+    "gpt-5": (1.25, 10.00),
+    "gpt-5-mini": (0.25, 2.00),
+    "gpt-5-nano": (0.05, 0.40),
+    "gpt-4.1": (2.00, 8.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1-nano": (0.10, 0.40),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+
+    "o4-mini": (1.10, 4.40),
+    "o3": (2.00, 8.00),
+    "o3-pro": (20.00, 80.00),
+    "o3-mini": (1.10, 4.40),
+}
+
+# Token budget for the "windowed" and "summarized" history modes
+HISTORY_WINDOW_TOKENS = 16_000
+
+# Upload downscaling targets by model prefix: (max long side, max short side).
+# OpenAI and Grok tile high-detail images after fitting 2048 / 768 px;
+# Gemini tiles 768 px squares, so larger images only cost more tokens.
+IMAGE_TARGETS = {
+    "gemini": (1536, 1536),
+    "grok": (2048, 768),
+}
+DEFAULT_IMAGE_TARGET = (2048, 768)
+
+
 MODEL_IMAGES = [ "gpt-image-1.5", "gpt-image-1-mini", "gpt-image-1" ]
 
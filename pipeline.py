@@ -0,0 +1,80 @@
+# pipeline.py
+"""Prompt pipeline shared by the Streamlit app and batch.py.
+
+Builds the user message (prompt + processed uploads), the stable system
+prefix from the option flags, packs history into the model's budget and
+runs the completion with telemetry.
+"""
+import io
+import mimetypes
+import os
+import time
+
+from history import pack_messages, materialize_messages
+from prompt import system_prompt
+from scheduler import admit
+from telemetry import track, TRACKED_STATS
+from utils import (
+    process_uploaded_files, provider_for, get_client, extract_reply, usage_stats, estimate_cost,
+    message_token_counts,
+)
+
+OPTION_NAMES = ["short", "interactive", "jobs", "image", "code_block"]
+
+
+class LocalFile(io.BytesIO):
+    """A file on disk shaped like Streamlit's UploadedFile (name, type, size)."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            super().__init__(f.read())
+        self.name = os.path.basename(path)
+        self.type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.size = len(self.getvalue())
+
+
+def client_for(model):
+    # Like utils.init_client, but raises instead of stopping a Streamlit run
+    _, env, url = provider_for(model)
+    if not (key := os.getenv(env)):
+        raise RuntimeError(f"{env} not set.")
+    return get_client(key, url)
+
+
+def build_user_message(prompt, files=(), model=None, text_limit=None, strict=False):
+    parts = process_uploaded_files(files, model, text_limit, strict)
+    return {"role": "user", "content": [{"type": "text", "text": prompt}] + parts}
+
+
+def prepare(messages, model, options, summarize=None, summaries=None):
+    """Pack `messages` behind the options' system prefix.
+
+    Returns (packed, info); packed still holds blob references and is what
+    the response cache keys on. Use materialize_messages() for the payload.
+    """
+    return pack_messages(
+        messages, model, options.get("history", "full"),
+        summarize=summarize, summaries=summaries, system=system_prompt(options),
+    )
+
+
+def image_prompt(options, text):
+    # images.generate has no system role, so the option prompts lead the prompt text
+    return "\n\n".join(filter(None, [system_prompt(options), text]))
+
+
+def complete(client, model, packed, username=None, kind="chat", on_wait=None):
+    """Blocking completion through the provider scheduler; returns (reply_text, stats)."""
+    stats = {}
+    payload = materialize_messages(packed)
+    tokens = sum(message_token_counts([], packed, model))
+    with admit(model, username, tokens, on_wait) as lease, track(kind, model, username, payload) as event:
+        started = time.perf_counter()
+        response = lease.call(client.chat.completions.create, model=model, messages=payload)
+        stats["elapsed"] = time.perf_counter() - started
+        if getattr(response, "usage", None) is not None:
+            usage_stats(response.usage, stats)
+            lease.used(stats)
+        stats["cost"] = estimate_cost(model, stats)
+        event.update({k: stats[k] for k in TRACKED_STATS if k in stats})
+    return extract_reply(response), stats
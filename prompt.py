@@ -74,9 +74,26 @@ Use the following content as the source for the infographic:
 
 """
 
+PROMPT_SUMMARY = """Summarize the conversation so far in a few short paragraphs. Keep names, numbers, decisions, code identifiers and open questions. Do not add new information."""
+
+PROMPT_SHORT = """ Give a short answer."""
+
+PROMPT_DOCUMENT = """You are reading one part of a longer document. Write dense notes on this part so that questions about the whole document can be answered from the notes alone. Keep names, numbers, dates, definitions, section headings and key claims; quote short passages when the wording matters. Do not add information that is not in the text."""
+
 PROMPTS = {
   "interactive": PROMPT_INTERACTIVE,
   "code_block": PROMPT_CODE_BLOCK,
   "jobs": PROMPT_JOBS,
-  "image": PROMPT_IMAGE
-}
\ No newline at end of file
+  "image": PROMPT_IMAGE,
+  "summary": PROMPT_SUMMARY,
+  "short": PROMPT_SHORT,
+  "document": PROMPT_DOCUMENT
+}
+
+# Option prompts are emitted in this fixed order as one system message at the
+# start of every request, so the static prefix is identical from turn to turn
+# and provider-side prompt caching can reuse it.
+OPTION_ORDER = ["image", "jobs", "interactive", "code_block", "short"]
+
+def system_prompt(options):
+    return "\n\n".join(PROMPTS[name].strip() for name in OPTION_ORDER if options.get(name))
@@ -0,0 +1,239 @@
+# scheduler.py
+"""Process-wide admission control for provider API calls.
+
+Every user of one server shares the provider API keys, so requests are
+admitted per provider through one queue:
+
+  - token buckets for requests/min and tokens/min (prompt tokens are
+    estimated up front and reconciled with the reported usage afterwards);
+  - start-time fair queuing, so a user with many queued requests cannot
+    starve one who has a single request waiting;
+  - AIMD concurrency: the in-flight limit grows by ~1 per window of
+    successes and halves on every 429, and a Retry-After pauses the whole
+    provider rather than just the request that hit it.
+
+Retries happen here rather than in the SDK (pooled clients are created with
+max_retries=0, see utils.get_client), so each one gives up its slot while it
+backs off, queues again, and counts against one RATE_LIMIT_RETRIES budget.
+"""
+import bisect
+import itertools
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from utils import provider_for, take_rate_limit
+
+# (requests/min, tokens/min) per provider; override with e.g.
+# CHATTERLIT_RATE_LIMITS="openai=500/200000,grok=60/100000"
+RATE_LIMITS = {"openai": (500, 200000), "grok": (60, 100000), "gemini": (60, 250000)}
+DEFAULT_RATE_LIMIT = (60, 100000)
+START_CONCURRENCY = float(os.getenv("CHATTERLIT_START_CONCURRENCY", "4"))
+MAX_CONCURRENCY = float(os.getenv("CHATTERLIT_MAX_CONCURRENCY", "32"))
+# Retries per call, for 429s and the transient errors the SDK would otherwise retry
+RATE_LIMIT_RETRIES = int(os.getenv("CHATTERLIT_RATE_LIMIT_RETRIES", "3"))
+RETRY_STATUSES = {408, 409, 429}
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+# Waiters wake at least this often to report their queue position
+WAIT_POLL = 0.5
+
+
+def _rate_limits():
+    limits = dict(RATE_LIMITS)
+    for item in filter(None, os.getenv("CHATTERLIT_RATE_LIMITS", "").split(",")):
+        name, _, value = item.partition("=")
+        rpm, _, tpm = value.partition("/")
+        limits[name.strip()] = (float(rpm), float(tpm or DEFAULT_RATE_LIMIT[1]))
+    return limits
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.level = self.capacity
+        self.rate = self.capacity / 60
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        # Requests larger than the bucket only wait for a full bucket
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount):
+        # May go negative when actual usage exceeds the estimate; later requests pay it back
+        self.level -= amount
+
+
+def _retryable(e):
+    status = getattr(e, "status_code", None)
+    if status is not None:
+        return status in RETRY_STATUSES or status >= 500
+    # openai.APIConnectionError (and APITimeoutError), matched by name to keep openai a lazy import
+    return any(cls.__name__ == "APIConnectionError" for cls in type(e).__mro__)
+
+
+class Lease:
+    """An admitted request; see ProviderScheduler.admit()."""
+
+    def __init__(self, scheduler, username, tokens):
+        self.scheduler = scheduler
+        self.username = username
+        self.tokens = tokens
+        self.throttled = False
+
+    def _check_throttled(self):
+        if (retry_after := take_rate_limit()) is not None:
+            self.throttled = True
+            self.scheduler.throttle(retry_after)
+
+    def call(self, fn, *args, **kwargs):
+        """Call fn, retrying rate limits and transient errors after a backoff."""
+        for attempt in itertools.count():
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                self._check_throttled()
+                if not _retryable(e) or attempt >= RATE_LIMIT_RETRIES:
+                    raise
+                delay = min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX) * random.uniform(0.5, 1.0)
+                # Back off without holding a slot, then queue again (the token
+                # estimate was charged on the first admission)
+                self.scheduler._release(grow=False)
+                try:
+                    time.sleep(max(delay, self.scheduler.paused_until - time.monotonic()))
+                finally:
+                    self.scheduler._acquire(self.username, 0, None)
+                continue
+            self._check_throttled()
+            return result
+
+    def used(self, stats):
+        """Charge the tokens/min bucket for the reported usage instead of the estimate."""
+        actual = stats.get("prompt_tokens", 0) + stats.get("completion_tokens", 0)
+        if actual:
+            self.scheduler.charge(actual - self.tokens)
+            self.tokens = actual
+
+
+class ProviderScheduler:
+    def __init__(self, name, requests_per_minute, tokens_per_minute):
+        self.name = name
+        self.cond = threading.Condition()
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.limit = START_CONCURRENCY
+        self.active = 0
+        self.paused_until = 0.0
+        # Sorted (tag, seq) tickets; a user's tag advances with each of their requests
+        self.waiting = []
+        self.user_tags = {}
+        self.virtual_time = 0.0
+        self.seq = itertools.count()
+        self.stats = {"admitted": 0, "throttled": 0, "max_wait": 0.0}
+
+    def _delay(self, tokens, now):
+        # None: wait for a running request to finish; otherwise seconds until admissible
+        if self.active >= int(self.limit):
+            return None
+        return max(self.paused_until - now, self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now), 0.0)
+
+    def _acquire(self, username, tokens, on_wait):
+        started = time.monotonic()
+        with self.cond:
+            tag = max(self.virtual_time, self.user_tags.get(username, 0.0)) + 1
+            self.user_tags[username] = tag
+            ticket = (tag, next(self.seq))
+            bisect.insort(self.waiting, ticket)
+        reported = None
+        try:
+            while True:
+                with self.cond:
+                    position = bisect.bisect_left(self.waiting, ticket)
+                    delay = self._delay(tokens, time.monotonic()) if position == 0 else None
+                    if delay == 0:
+                        self.waiting.remove(ticket)
+                        self.cond.notify_all()
+                        self.requests.take(1)
+                        self.tokens.take(tokens)
+                        self.active += 1
+                        self.virtual_time = tag
+                        self.stats["admitted"] += 1
+                        self.stats["max_wait"] = max(self.stats["max_wait"], time.monotonic() - started)
+                        return
+                    if on_wait is None or position == reported:
+                        self.cond.wait(min(delay or WAIT_POLL, WAIT_POLL))
+                        continue
+                # Outside the lock: on_wait updates the UI, and every provider call waits on this lock
+                on_wait(position + 1)
+                reported = position
+        except BaseException:
+            with self.cond:
+                self.waiting.remove(ticket)
+                self.cond.notify_all()
+            raise
+
+    def _release(self, grow):
+        with self.cond:
+            self.active -= 1
+            if grow:
+                self.limit = min(MAX_CONCURRENCY, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+    @contextmanager
+    def admit(self, username, tokens=0, on_wait=None):
+        """Wait for a slot; on_wait(position) is called when the queue position changes."""
+        self._acquire(username, tokens, on_wait)
+        lease = Lease(self, username, tokens)
+        try:
+            yield lease
+        finally:
+            self._release(grow=not lease.throttled)
+
+    def throttle(self, retry_after=None):
+        with self.cond:
+            self.limit = max(1.0, self.limit / 2)
+            self.paused_until = max(self.paused_until, time.monotonic() + (retry_after or BACKOFF_BASE))
+            self.stats["throttled"] += 1
+
+    def charge(self, tokens):
+        with self.cond:
+            self.tokens.take(tokens)
+
+    def snapshot(self):
+        with self.cond:
+            return {
+                **self.stats,
+                "limit": round(self.limit, 2),
+                "active": self.active,
+                "queued": len(self.waiting),
+                "paused_s": round(max(self.paused_until - time.monotonic(), 0.0), 1),
+            }
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(model):
+    name = provider_for(model)[0]
+    with _schedulers_lock:
+        if name not in _schedulers:
+            _schedulers[name] = ProviderScheduler(name, *_rate_limits().get(name, DEFAULT_RATE_LIMIT))
+        return _schedulers[name]
+
+
+def admit(model, username=None, tokens=0, on_wait=None):
+    return get_scheduler(model).admit(username, tokens, on_wait)
+
+
+def scheduler_stats():
+    with _schedulers_lock:
+        return {name: scheduler.snapshot() for name, scheduler in _schedulers.items()}
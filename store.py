@@ -0,0 +1,469 @@
+# store.py
+import base64
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from urllib.parse import urlparse
+
+DEFAULT_STORE_URL = "sqlite:///data/chatterlit.db"
+# Job records are kept this long in stores that expire keys (Redis)
+JOB_RETENTION = float(os.getenv("CHATTERLIT_JOB_RETENTION", str(7 * 24 * 3600)))
+
+
+def _encode(value):
+    # Message content can carry raw bytes (generated images)
+    if isinstance(value, bytes):
+        return {"__bytes__": base64.b64encode(value).decode()}
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def _decode(obj):
+    if "__bytes__" in obj and len(obj) == 1:
+        return base64.b64decode(obj["__bytes__"])
+    return obj
+
+
+def dumps(message):
+    return json.dumps(message, default=_encode)
+
+
+def loads(text):
+    return json.loads(text, object_hook=_decode)
+
+
+def search_text(message):
+    """The searchable text of a message: every text part, plus compared answers."""
+    content = message.get("content")
+    if isinstance(content, str):
+        parts = [content]
+    else:
+        parts = [p["text"] for p in content or [] if isinstance(p, dict) and p.get("type") == "text"]
+    parts += [c["content"] for c in message.get("compare", []) if isinstance(c.get("content"), str)]
+    return "\n".join(parts)
+
+
+def like_pattern(query):
+    # LIKE pattern for a substring, with the user's % and _ matched literally
+    return "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def _like_snippet(text, query, width=60):
+    at = max(text.lower().find(query.lower()), 0)
+    return "…" + text[max(at - width, 0):at + len(query) + width] + "…"
+
+
+def fts_query(query):
+    # Quote every term so user input can't inject FTS5 syntax; the last term
+    # matches as a prefix so results update while typing
+    terms = ['"' + t.replace('"', '""') + '"' for t in query.split()]
+    if terms:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+class SessionStore(ABC):
+    """Per-user chat session storage.
+
+    Sessions are listed through a lightweight index (id, title, timestamps)
+    and messages are only loaded for the session being viewed. Messages are
+    append-only. Per-user state (the open session, an in-flight reply) lives
+    here too, so any app replica sharing the store can serve any user.
+    """
+
+    @abstractmethod
+    def list_sessions(self, username):
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_messages(self, username, session_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def append_message(self, username, session_id, message):
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_message(self, username, session_id, seq, message):
+        """Replace a message in place, e.g. an image message once its jobs have finished."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_title(self, username, session_id, title):
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_job(self, username, job_id, status, result=None, error=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_jobs(self, job_ids):
+        raise NotImplementedError
+
+    @abstractmethod
+    def search(self, username, query, limit=20):
+        """Ranked matches over the user's messages: session_id, title, seq, role, snippet."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_state(self, username, key, default=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_state(self, username, key, value):
+        """Set a JSON-serializable per-user value; None deletes it."""
+        raise NotImplementedError
+
+
+class SQLiteStore(SessionStore):
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                username TEXT NOT NULL,
+                session_id TEXT NOT NULL,
+                title TEXT NOT NULL DEFAULT '',
+                created REAL NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (username, session_id)
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT NOT NULL,
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                message TEXT NOT NULL
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS messages_session
+                ON messages (username, session_id, seq);
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                username TEXT NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                updated REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS user_state (
+                username TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (username, key)
+            );
+        """)
+        # The LIKE fallback matches the same text the full-text index holds, not the raw JSON
+        self.conn.create_function("search_text", 1, lambda message: search_text(loads(message)), deterministic=True)
+        self.fts = self._init_fts()
+
+    def _init_fts(self):
+        # Full-text index kept in step with messages by append_message; SQLite
+        # builds without FTS5 fall back to a LIKE scan in search()
+        try:
+            self.conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+                "text, username UNINDEXED, session_id UNINDEXED, seq UNINDEXED, role UNINDEXED,"
+                " tokenize = 'unicode61 remove_diacritics 2')"
+            )
+        except sqlite3.OperationalError:
+            return False
+        # Index messages written before the index existed, once
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] < 1:
+            self.conn.execute("BEGIN IMMEDIATE")
+            rows = self.conn.execute("SELECT username, session_id, seq, message FROM messages").fetchall()
+            for username, session_id, seq, message in rows:
+                self._index(username, session_id, seq, loads(message))
+            self.conn.execute("PRAGMA user_version = 1")
+            self.conn.execute("COMMIT")
+        return True
+
+    def _index(self, username, session_id, seq, message):
+        if text := search_text(message):
+            self.conn.execute(
+                "INSERT INTO messages_fts (text, username, session_id, seq, role) VALUES (?, ?, ?, ?, ?)",
+                (text, username, session_id, seq, message.get("role", "")),
+            )
+
+    def list_sessions(self, username):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT session_id, title, created, updated FROM sessions"
+                " WHERE username = ? ORDER BY session_id DESC",
+                (username,),
+            ).fetchall()
+        return [{"session_id": r[0], "title": r[1], "created": r[2], "updated": r[3]} for r in rows]
+
+    def load_messages(self, username, session_id):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT message FROM messages WHERE username = ? AND session_id = ? ORDER BY seq",
+                (username, session_id),
+            ).fetchall()
+        return [loads(r[0]) for r in rows]
+
+    def append_message(self, username, session_id, message):
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Sessions are created lazily by their first message
+                self.conn.execute(
+                    "INSERT INTO sessions (username, session_id, created, updated) VALUES (?, ?, ?, ?)"
+                    " ON CONFLICT (username, session_id) DO UPDATE SET updated = excluded.updated",
+                    (username, session_id, now, now),
+                )
+                seq = self.conn.execute(
+                    "INSERT INTO messages (username, session_id, seq, message) VALUES (?, ?,"
+                    " (SELECT COALESCE(MAX(seq), -1) + 1 FROM messages WHERE username = ? AND session_id = ?), ?)"
+                    " RETURNING seq",
+                    (username, session_id, username, session_id, dumps(message)),
+                ).fetchone()[0]
+                if self.fts:
+                    self._index(username, session_id, seq, message)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def update_message(self, username, session_id, seq, message):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute(
+                    "UPDATE messages SET message = ? WHERE username = ? AND session_id = ? AND seq = ?",
+                    (dumps(message), username, session_id, seq),
+                )
+                if self.fts:
+                    self.conn.execute(
+                        "DELETE FROM messages_fts WHERE username = ? AND session_id = ? AND seq = ?",
+                        (username, session_id, seq),
+                    )
+                    self._index(username, session_id, seq, message)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def set_title(self, username, session_id, title):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE sessions SET title = ? WHERE username = ? AND session_id = ?",
+                (title, username, session_id),
+            )
+
+    def set_job(self, username, job_id, status, result=None, error=None):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO jobs (job_id, username, status, result, error, updated)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, username, status, dumps(result), error, time.time()),
+            )
+
+    def get_jobs(self, job_ids):
+        if not job_ids:
+            return {}
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT job_id, status, result, error, updated FROM jobs"
+                f" WHERE job_id IN ({','.join('?' * len(job_ids))})",
+                list(job_ids),
+            ).fetchall()
+        return {r[0]: {"status": r[1], "result": loads(r[2]), "error": r[3], "updated": r[4]} for r in rows}
+
+    def search(self, username, query, limit=20):
+        if not query.strip():
+            return []
+        with self.lock:
+            if self.fts:
+                rows = self.conn.execute(
+                    "SELECT f.session_id, s.title, f.seq, f.role,"
+                    " snippet(messages_fts, 0, '**', '**', '…', 12)"
+                    " FROM messages_fts f LEFT JOIN sessions s"
+                    " ON s.username = f.username AND s.session_id = f.session_id"
+                    " WHERE messages_fts MATCH ? AND f.username = ? ORDER BY rank LIMIT ?",
+                    (fts_query(query), username, limit),
+                ).fetchall()
+            else:
+                rows = self.conn.execute(
+                    "SELECT m.session_id, s.title, m.seq, json_extract(m.message, '$.role'), search_text(m.message)"
+                    " FROM messages m LEFT JOIN sessions s"
+                    " ON s.username = m.username AND s.session_id = m.session_id"
+                    " WHERE m.username = ? AND search_text(m.message) LIKE ? ESCAPE '\\'"
+                    " ORDER BY m.id DESC LIMIT ?",
+                    (username, like_pattern(query.strip()), limit),
+                ).fetchall()
+                rows = [r[:4] + (_like_snippet(r[4], query.strip()),) for r in rows]
+        return [
+            {"session_id": r[0], "title": r[1] or "", "seq": int(r[2]), "role": r[3], "snippet": r[4]}
+            for r in rows
+        ]
+
+    def get_state(self, username, key, default=None):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value FROM user_state WHERE username = ? AND key = ?", (username, key),
+            ).fetchone()
+        return loads(row[0]) if row else default
+
+    def set_state(self, username, key, value):
+        with self.lock:
+            if value is None:
+                self.conn.execute("DELETE FROM user_state WHERE username = ? AND key = ?", (username, key))
+            else:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO user_state (username, key, value, updated) VALUES (?, ?, ?, ?)",
+                    (username, key, dumps(value), time.time()),
+                )
+
+
+def search_terms(text):
+    return {t for t in re.findall(r"\w+", text.lower()) if len(t) > 1}
+
+
+class RedisStore(SessionStore):
+    """Store on a Redis-compatible server, for several app replicas behind one load balancer.
+
+    Keys, under `prefix`:
+      user:<u>:sessions          sorted set of session ids (score: created)
+      user:<u>:session:<id>      hash of title, created, updated
+      user:<u>:messages:<id>     list of JSON messages; the index is the seq
+      user:<u>:terms:<term>      set of "<id>\x1f<seq>" for search
+      user:<u>:state             hash of JSON per-user values
+      job:<job_id>               hash of job status, expires after JOB_RETENTION
+
+    Search matches whole words (all query terms) and ranks newest first;
+    there is no FTS5 here, only the term sets maintained on append.
+    """
+
+    def __init__(self, client, prefix="chatterlit"):
+        self.redis = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url):
+        import redis
+
+        return cls(redis.Redis.from_url(url, decode_responses=True))
+
+    def _key(self, *parts):
+        return ":".join((self.prefix,) + parts)
+
+    def list_sessions(self, username):
+        session_ids = sorted(self.redis.zrange(self._key("user", username, "sessions"), 0, -1), reverse=True)
+        pipe = self.redis.pipeline(transaction=False)
+        for session_id in session_ids:
+            pipe.hgetall(self._key("user", username, "session", session_id))
+        return [
+            {"session_id": session_id, "title": info.get("title", ""),
+             "created": float(info.get("created", 0)), "updated": float(info.get("updated", 0))}
+            for session_id, info in zip(session_ids, pipe.execute())
+        ]
+
+    def load_messages(self, username, session_id):
+        return [loads(m) for m in self.redis.lrange(self._key("user", username, "messages", session_id), 0, -1)]
+
+    def append_message(self, username, session_id, message):
+        now = time.time()
+        # RPUSH is atomic, so concurrent replicas appending to one session get distinct seqs
+        seq = self.redis.rpush(self._key("user", username, "messages", session_id), dumps(message)) - 1
+        pipe = self.redis.pipeline()
+        pipe.zadd(self._key("user", username, "sessions"), {session_id: now}, nx=True)
+        session_key = self._key("user", username, "session", session_id)
+        pipe.hsetnx(session_key, "created", now)
+        pipe.hset(session_key, "updated", now)
+        for term in search_terms(search_text(message)):
+            pipe.sadd(self._key("user", username, "terms", term), f"{session_id}\x1f{seq}")
+        pipe.execute()
+
+    def update_message(self, username, session_id, seq, message):
+        key = self._key("user", username, "messages", session_id)
+        old = self.redis.lindex(key, seq)
+        old_terms = search_terms(search_text(loads(old))) if old is not None else set()
+        new_terms = search_terms(search_text(message))
+        pipe = self.redis.pipeline()
+        pipe.lset(key, seq, dumps(message))
+        for term in old_terms - new_terms:
+            pipe.srem(self._key("user", username, "terms", term), f"{session_id}\x1f{seq}")
+        for term in new_terms - old_terms:
+            pipe.sadd(self._key("user", username, "terms", term), f"{session_id}\x1f{seq}")
+        pipe.execute()
+
+    def set_title(self, username, session_id, title):
+        self.redis.hset(self._key("user", username, "session", session_id), "title", title)
+
+    def set_job(self, username, job_id, status, result=None, error=None):
+        key = self._key("job", job_id)
+        pipe = self.redis.pipeline()
+        pipe.hset(key, mapping={
+            "username": username, "status": status, "result": dumps(result),
+            "error": error or "", "updated": time.time(),
+        })
+        pipe.expire(key, int(JOB_RETENTION))
+        pipe.execute()
+
+    def get_jobs(self, job_ids):
+        job_ids = list(job_ids)
+        pipe = self.redis.pipeline(transaction=False)
+        for job_id in job_ids:
+            pipe.hgetall(self._key("job", job_id))
+        return {
+            job_id: {"status": job["status"], "result": loads(job["result"]), "error": job["error"] or None,
+                     "updated": float(job["updated"])}
+            for job_id, job in zip(job_ids, pipe.execute()) if job
+        }
+
+    def search(self, username, query, limit=20):
+        terms = search_terms(query)
+        if not terms:
+            return []
+        hits = self.redis.sinter([self._key("user", username, "terms", t) for t in terms])
+        hits = sorted((h.split("\x1f") for h in hits), key=lambda h: (h[0], int(h[1])), reverse=True)[:limit]
+        pipe = self.redis.pipeline(transaction=False)
+        for session_id, seq in hits:
+            pipe.lindex(self._key("user", username, "messages", session_id), int(seq))
+            pipe.hget(self._key("user", username, "session", session_id), "title")
+        replies = pipe.execute()
+        results = []
+        for (session_id, seq), message, title in zip(hits, replies[::2], replies[1::2]):
+            message = loads(message)
+            results.append({
+                "session_id": session_id, "title": title or "", "seq": int(seq), "role": message.get("role", ""),
+                "snippet": _like_snippet(search_text(message), max(terms, key=len)),
+            })
+        return results
+
+    def get_state(self, username, key, default=None):
+        value = self.redis.hget(self._key("user", username, "state"), key)
+        return loads(value) if value is not None else default
+
+    def set_state(self, username, key, value):
+        if value is None:
+            self.redis.hdel(self._key("user", username, "state"), key)
+        else:
+            self.redis.hset(self._key("user", username, "state"), key, dumps(value))
+
+
+# Backends by URL scheme; register additional ones here
+STORES = {
+    # sqlite:///relative/path.db or sqlite:////absolute/path.db
+    "sqlite": lambda url: SQLiteStore(url.path[1:]),
+    # redis://[:password@]host:port/db (rediss:// for TLS); needs the redis package
+    "redis": lambda url: RedisStore.from_url(url.geturl()),
+    "rediss": lambda url: RedisStore.from_url(url.geturl()),
+}
+
+
+def open_store(url=None):
+    url = url or os.getenv("CHATTERLIT_STORE", DEFAULT_STORE_URL)
+    parsed = urlparse(url)
+    if parsed.scheme not in STORES:
+        raise ValueError(f"Unsupported store backend: {parsed.scheme}")
+    return STORES[parsed.scheme](parsed)
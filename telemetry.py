@@ -0,0 +1,189 @@
+# telemetry.py
+import contextlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+from logging.handlers import RotatingFileHandler
+
+from utils import provider_for, thread_request_count
+
+DEFAULT_LOG_PATH = "data/requests.jsonl"
+LOG_MAX_BYTES = int(os.getenv("CHATTERLIT_TELEMETRY_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUPS = int(os.getenv("CHATTERLIT_TELEMETRY_BACKUPS", "5"))
+# Optional Prometheus textfile-collector export, rewritten after every request
+PROMETHEUS_FILE = os.getenv("CHATTERLIT_PROMETHEUS_FILE")
+# Recent events kept in memory per (kind, model) for percentiles
+WINDOW = 1000
+
+# Reply stats (see utils.stream_reply / usage_stats) copied onto request events
+TRACKED_STATS = ["ttft", "tokens_per_sec", "prompt_tokens", "completion_tokens", "cached_tokens", "cost"]
+
+# Reentrant: the replay and the Prometheus export read the aggregates while holding it
+_lock = threading.RLock()
+_logger = None
+_replayed = False
+_recent = defaultdict(lambda: deque(maxlen=WINDOW))
+_totals = defaultdict(lambda: {"requests": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0})
+
+
+def _get_logger():
+    global _logger
+    with _lock:
+        if _logger is None:
+            path = _log_path()
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            logger = logging.getLogger("chatterlit.requests")
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            handler = RotatingFileHandler(path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger.addHandler(handler)
+            _logger = logger
+        return _logger
+
+
+def _log_path():
+    return os.getenv("CHATTERLIT_TELEMETRY_LOG", DEFAULT_LOG_PATH)
+
+
+def _add(event):
+    key = (event["kind"], event["model"])
+    with _lock:
+        _recent[key].append(event)
+        totals = _totals[key]
+        totals["requests"] += 1
+        totals["errors"] += event.get("status") == "error"
+        for field in ("prompt_tokens", "completion_tokens", "cached_tokens"):
+            totals[field] += event.get(field) or 0
+
+
+def _replay():
+    # Seed the aggregates from the current log file after a restart
+    global _replayed
+    with _lock:
+        if _replayed:
+            return
+        _replayed = True
+        try:
+            with open(_log_path()) as f:
+                for line in f:
+                    with contextlib.suppress(ValueError, KeyError):
+                        _add(json.loads(line))
+        except OSError:
+            pass
+
+
+def record(event):
+    """Append one request event to the JSONL log and the in-memory aggregates.
+
+    Never raises: the request it describes has already been made (and paid for).
+    """
+    try:
+        _replay()
+        _add(event)
+        _get_logger().info(json.dumps(event, default=str))
+        if PROMETHEUS_FILE:
+            export_prometheus(PROMETHEUS_FILE)
+    except Exception:
+        logging.getLogger(__name__).exception("Could not record a %s request", event.get("kind"))
+
+
+@contextlib.contextmanager
+def track(kind, model, username=None, payload=None):
+    """Time one API call and record it.
+
+    The yielded dict is the event; callers add fields such as ttft,
+    prompt/completion/cached tokens or cached=True before the block exits.
+    Exceptions are recorded with status "error" and re-raised.
+    """
+    event = {"ts": time.time(), "kind": kind, "model": model, "provider": provider_for(model)[0], "user": username}
+    if payload is not None:
+        event["payload_bytes"] = len(json.dumps(payload, default=str))
+    attempts = thread_request_count()
+    started = time.perf_counter()
+    try:
+        yield event
+        event.setdefault("status", "ok")
+    except Exception as e:
+        event["status"] = "error"
+        event["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        event["wall_s"] = time.perf_counter() - started
+        event["retries"] = max(thread_request_count() - attempts - 1, 0)
+        record(event)
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def aggregates():
+    """Per (kind, model) summary of recent requests: latency percentiles, tokens/sec, errors."""
+    _replay()
+    rows = []
+    with _lock:
+        items = [(key, list(events), dict(_totals[key])) for key, events in _recent.items()]
+    for (kind, model), events, totals in sorted(items):
+        ok = [e for e in events if e.get("status") == "ok" and not e.get("cached")]
+        latencies = [e["wall_s"] for e in ok]
+        ttfts = [e["ttft"] for e in ok if "ttft" in e]
+        rates = [e["tokens_per_sec"] for e in ok if e.get("tokens_per_sec")]
+        rows.append({
+            "kind": kind,
+            "model": model,
+            "requests": totals["requests"],
+            "errors": totals["errors"],
+            "p50_s": _percentile(latencies, 0.5),
+            "p95_s": _percentile(latencies, 0.95),
+            "p50_ttft_s": _percentile(ttfts, 0.5),
+            "tokens_per_sec": sum(rates) / len(rates) if rates else None,
+            "prompt_tokens": totals["prompt_tokens"],
+            "completion_tokens": totals["completion_tokens"],
+            "cached_tokens": totals["cached_tokens"],
+            "retries": sum(e.get("retries", 0) for e in events),
+        })
+    return rows
+
+
+def prometheus_text():
+    lines = [
+        "# TYPE chatterlit_requests_total counter",
+        "# TYPE chatterlit_request_errors_total counter",
+        "# TYPE chatterlit_tokens_total counter",
+        "# TYPE chatterlit_request_latency_seconds summary",
+    ]
+    for row in aggregates():
+        labels = f'kind="{row["kind"]}",model="{row["model"]}"'
+        lines.append(f"chatterlit_requests_total{{{labels}}} {row['requests']}")
+        lines.append(f"chatterlit_request_errors_total{{{labels}}} {row['errors']}")
+        for field in ("prompt", "completion", "cached"):
+            lines.append(f'chatterlit_tokens_total{{{labels},type="{field}"}} {row[field + "_tokens"]}')
+        for quantile, field in (("0.5", "p50_s"), ("0.95", "p95_s")):
+            if row[field] is not None:
+                lines.append(f'chatterlit_request_latency_seconds{{{labels},quantile="{quantile}"}} {row[field]:.6f}')
+    return "\n".join(lines) + "\n"
+
+
+def export_prometheus(path):
+    # Write then rename so the collector never reads a partial file; the
+    # temp file is unique and the rename serialized, as any thread may export
+    with _lock:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".chatterlit-", suffix=".prom.tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(prometheus_text())
+            os.chmod(tmp, 0o644)  # mkstemp creates it private; the collector may run as another user
+            os.replace(tmp, path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+            raise
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import fakeredis
+import pytest
+
+# The app modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from store import RedisStore, SQLiteStore  # noqa: E402
+
+
+@pytest.fixture
+def redis_client():
+    return fakeredis.FakeRedis(decode_responses=True)
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def store(request, tmp_path):
+    if request.param == "sqlite":
+        return SQLiteStore(str(tmp_path / "chatterlit.db"))
+    return RedisStore(request.getfixturevalue("redis_client"))
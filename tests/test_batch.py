@@ -0,0 +1,53 @@
+import json
+import sys
+
+import pytest
+
+import batch
+import uploads
+from batch import build_packed, completed_ids, read_inputs
+
+
+def test_read_inputs_jsonl(tmp_path):
+    path = tmp_path / "inputs.jsonl"
+    path.write_text("\n".join(json.dumps(row) for row in [{"id": 0, "prompt": "a"}, {"prompt": "b"}, {"id": "x", "prompt": "c"}]) + "\n\n")
+    assert [row["id"] for row in read_inputs(str(path))] == ["0", "1", "x"]
+
+
+def test_read_inputs_csv(tmp_path):
+    path = tmp_path / "inputs.csv"
+    path.write_text("id,prompt,files\n,a,one.txt;two.png\n7,b,\n")
+    rows = read_inputs(str(path))
+    assert [row["id"] for row in rows] == ["0", "7"]
+    assert rows[0]["files"] == ["one.txt", "two.png"]
+    assert rows[1]["files"] == []
+
+
+def test_completed_ids_resume(tmp_path):
+    path = tmp_path / "results.jsonl"
+    assert completed_ids(str(path)) == set()
+    path.write_text(
+        json.dumps({"id": "0", "output": "ok"}) + "\n"
+        + json.dumps({"id": "1", "error": "rate limited"}) + "\n"
+        + json.dumps({"id": "2", "output": "ok"}) + "\n"
+        + '{"id": "3", "outp'  # cut off by an interruption
+    )
+    # Failed and partly written rows run again
+    assert completed_ids(str(path)) == {"0", "2"}
+
+
+def test_rejected_file_fails_the_row(tmp_path, monkeypatch):
+    upload = tmp_path / "notes.txt"
+    upload.write_text("too big")
+    monkeypatch.setattr(uploads, "MAX_UPLOAD_BYTES", 3)
+    with pytest.raises(ValueError, match="notes.txt"):
+        build_packed({"prompt": "summarize", "files": [str(upload)]}, "gpt-4o-mini", {})
+
+
+def test_batch_api_needs_an_openai_model(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(sys, "argv", [
+        "batch.py", str(tmp_path / "missing.jsonl"), str(tmp_path / "out.jsonl"), "--model", "grok-4-latest", "--batch-api",
+    ])
+    with pytest.raises(SystemExit):
+        batch.main()
+    assert "--batch-api needs an OpenAI model" in capsys.readouterr().err
@@ -0,0 +1,43 @@
+import base64
+import hashlib
+import io
+
+import pytest
+
+import blobs
+from blobs import BlobStore
+
+
+@pytest.fixture
+def blob_store(tmp_path):
+    return BlobStore(str(tmp_path / "blobs"))
+
+
+def test_put_and_read(blob_store):
+    digest = blob_store.put(b"png bytes")
+    assert digest == hashlib.sha256(b"png bytes").hexdigest()
+    assert blob_store.exists(digest)
+    assert blob_store.read(digest) == b"png bytes"
+    assert blob_store.read(digest, 3) == b"png"
+    assert blob_store.b64encode(digest) == base64.b64encode(b"png bytes").decode()
+    assert blob_store.data_url(digest, "image/png").startswith("data:image/png;base64,")
+
+
+def test_put_file_in_chunks(blob_store, tmp_path, monkeypatch):
+    monkeypatch.setattr(blobs, "CHUNK_SIZE", 7)
+    data = bytes(range(256)) * 10
+    file = io.BytesIO(data)
+    file.read(5)  # put_file starts from the beginning wherever the file was left
+
+    digest = blob_store.put_file(file)
+    assert digest == blob_store.put(data)
+    assert blob_store.read(digest) == data
+    # Stored once, and no temp files left behind
+    assert blob_store.put_file(io.BytesIO(data)) == digest
+    files = [p for p in (tmp_path / "blobs").rglob("*") if p.is_file()]
+    assert [p.name for p in files] == [digest[2:]]
+
+
+def test_empty_blob(blob_store):
+    digest = blob_store.put_file(io.BytesIO(b""))
+    assert blob_store.b64encode(digest) == ""
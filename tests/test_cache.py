@@ -0,0 +1,57 @@
+import time
+
+import pytest
+
+from cache import CacheMapping, RedisCache, ResponseCache, cache_key
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def cache(request, tmp_path):
+    if request.param == "sqlite":
+        return ResponseCache(str(tmp_path / "cache.db"))
+    return RedisCache(request.getfixturevalue("redis_client"))
+
+
+def test_cache_key_is_canonical():
+    assert cache_key("chat", {"a": 1, "b": 2}) == cache_key("chat", {"b": 2, "a": 1})
+    assert cache_key("chat", "x") != cache_key("image", "x")
+
+
+def test_get_and_put(cache):
+    assert cache.get("k") is None
+    cache.put("k", {"reply": "hi", "stats": {"tokens": 2}})
+    assert cache.get("k") == {"reply": "hi", "stats": {"tokens": 2}}
+
+
+def test_entries_expire(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.db"), ttl=0.05)
+    cache.put("k", "v")
+    time.sleep(0.1)
+    assert cache.get("k") is None
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.db"), max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    time.sleep(0.01)
+    cache.get("a")
+    cache.put("c", 3)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+
+
+def test_redis_entries_expire(redis_client):
+    RedisCache(redis_client, ttl=60).put("k", "v")
+    assert 0 < redis_client.ttl("chatterlit:cache:k") <= 60
+
+
+def test_cache_mapping(cache):
+    summaries = CacheMapping(cache, "summary")
+    other = CacheMapping(cache, "other")
+    assert "span" not in summaries
+    summaries["span"] = "the summary"
+    assert "span" in summaries
+    assert summaries["span"] == "the summary"
+    assert "span" not in other
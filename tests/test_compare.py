@@ -0,0 +1,75 @@
+import contextlib
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import compare
+from compare import fan_out
+
+
+def chunk(text):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))], usage=None)
+
+
+class Stream:
+    def __init__(self, words, delay):
+        self.words, self.delay = words, delay
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        for word in self.words:
+            if self.closed.is_set():
+                return
+            time.sleep(self.delay)
+            yield chunk(word)
+
+    def close(self):
+        self.closed.set()
+
+
+class Client:
+    def __init__(self, stream=None, error=None):
+        self.stream, self.error = stream, error
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **kwargs):
+        if self.error:
+            raise self.error
+        return self.stream
+
+
+@pytest.fixture(autouse=True)
+def no_telemetry(monkeypatch):
+    @contextlib.contextmanager
+    def track(*args, **kwargs):
+        yield {}
+    monkeypatch.setattr(compare, "track", track)
+
+
+def test_fan_out_streams_every_model():
+    requests = [
+        ("gpt-4o-mini", Client(Stream(["a", "b"], 0.01)), [], 0),
+        ("gpt-4.1-mini", Client(error=ValueError("bad request")), [], 0),
+    ]
+    texts, results = {}, {}
+    for model, delta, stats in fan_out(requests):
+        if delta is None:
+            results[model] = stats
+        else:
+            texts[model] = texts.get(model, "") + delta
+    assert texts == {"gpt-4o-mini": "ab", "gpt-4.1-mini": "Error: bad request"}
+    assert results["gpt-4.1-mini"]["error"] == "bad request"
+    assert "error" not in results["gpt-4o-mini"]
+
+
+def test_closing_fan_out_cancels_the_streams():
+    slow = Stream(["w"] * 1000, 0.01)
+    replies = fan_out([("gpt-4o-mini", Client(slow), [], 0)])
+    started = time.monotonic()
+    with contextlib.closing(replies):
+        next(replies)
+    # Doesn't wait ~10 s for the rest of the stream, and the stream is closed
+    assert time.monotonic() - started < 2
+    assert slow.closed.wait(2)
@@ -0,0 +1,100 @@
+import threading
+
+import pytest
+
+import documents
+from documents import chunk_text, condense, map_chunks
+
+
+class WordEncoding:
+    """One token per word, so chunk boundaries are easy to check."""
+
+    name = "words"
+
+    def encode(self, text, disallowed_special=()):
+        return text.split()
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+
+@pytest.fixture
+def words(monkeypatch):
+    monkeypatch.setattr(documents, "_encoding", lambda model: WordEncoding())
+    documents.text_tokens.cache_clear()
+    yield
+    documents.text_tokens.cache_clear()
+
+
+def numbered(n):
+    return " ".join(f"w{i}" for i in range(n))
+
+
+def test_chunk_text_overlaps(words):
+    chunks = chunk_text(numbered(25), "m", chunk_tokens=10, overlap=2)
+    assert [c.split()[0] for c in chunks] == ["w0", "w8", "w16"]
+    assert all(len(c.split()) <= 10 for c in chunks)
+    assert chunks[-1].split()[-1] == "w24"
+    assert chunk_text("short", "m", chunk_tokens=10, overlap=2) == ["short"]
+
+
+def test_chunk_text_without_a_tokenizer(monkeypatch):
+    monkeypatch.setattr(documents, "_encoding", lambda model: None)
+    text = "x" * 100
+    chunks = chunk_text(text, "m", chunk_tokens=10, overlap=2)
+    assert all(len(c) <= 10 * documents.CHARS_PER_TOKEN for c in chunks)
+    assert "".join(c[:8 * documents.CHARS_PER_TOKEN] for c in chunks[:-1]) + chunks[-1] == text
+
+
+def fake_complete(calls, fail_on=None):
+    lock = threading.Lock()
+
+    def complete(client, model, packed, username=None, kind=None):
+        chunk = packed[-1]["content"]
+        with lock:
+            calls.append(chunk)
+        if fail_on is not None and fail_on in chunk:
+            raise RuntimeError("map failed")
+        return f"note({len(chunk.split())})", {}
+    return complete
+
+
+def test_condense_maps_until_the_notes_fit(words, monkeypatch):
+    calls = []
+    monkeypatch.setattr(documents, "complete", fake_complete(calls))
+    text = numbered(documents.DOC_THRESHOLD_TOKENS + 8000)
+    notes = condense(text, None, "m")
+    chunks = chunk_text(text, "m")
+    assert len(calls) == len(chunks) > 1
+    assert notes.startswith(f"[Part 1/{len(chunks)}]\nnote({documents.DOC_CHUNK_TOKENS})")
+    assert documents.text_tokens(notes, "m") <= documents.DOC_THRESHOLD_TOKENS
+
+
+def test_condense_leaves_small_text_alone(words, monkeypatch):
+    calls = []
+    monkeypatch.setattr(documents, "complete", fake_complete(calls))
+    assert condense("a few words", None, "m") == "a few words"
+    assert calls == []
+
+
+def test_map_chunks_uses_the_cache(words, monkeypatch):
+    calls = []
+    monkeypatch.setattr(documents, "complete", fake_complete(calls))
+    cache = {}
+
+    class Cache:
+        get = staticmethod(cache.get)
+        put = staticmethod(cache.__setitem__)
+
+    assert map_chunks(None, "m", ["a b", "c"], cache=Cache()) == ["note(2)", "note(1)"]
+    assert map_chunks(None, "m", ["a b", "c"], cache=Cache()) == ["note(2)", "note(1)"]
+    assert len(calls) == 2
+
+
+def test_map_chunks_cancels_queued_chunks_on_failure(words, monkeypatch):
+    calls = []
+    monkeypatch.setattr(documents, "complete", fake_complete(calls, fail_on="c0"))
+    monkeypatch.setattr(documents, "DOC_PARALLELISM", 1)
+    with pytest.raises(RuntimeError):
+        map_chunks(None, "m", [f"c{i}" for i in range(10)])
+    assert len(calls) < 10
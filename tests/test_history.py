@@ -0,0 +1,128 @@
+import pytest
+
+import history
+from history import history_budget, pack_messages
+
+
+def words(msg, model):
+    content = msg["content"]
+    if isinstance(content, str):
+        return len(content.split())
+    return sum(len(part["text"].split()) for part in content if part["type"] == "text")
+
+
+@pytest.fixture(autouse=True)
+def word_tokens(monkeypatch):
+    # One token per word, and a small window so budgets are easy to hit
+    monkeypatch.setattr(history, "count_tokens", words)
+    monkeypatch.setattr(history, "HISTORY_WINDOW_TOKENS", 35)
+    monkeypatch.setattr(history, "SUMMARY_RESERVE_TOKENS", 10)
+
+
+def turns(n, size=10):
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": " ".join([f"m{i}"] * size)}
+        for i in range(n)
+    ]
+
+
+def tokens(packed):
+    return sum(words(msg, None) for msg in packed)
+
+
+def test_budget_reserves_room_for_the_reply():
+    assert history_budget("gpt-4o", "full") == 128_000 - 16_384
+    assert history_budget("gpt-5-mini", "full") == 400_000 - 128_000
+    assert history_budget("gpt-4o", "windowed") == 35
+
+
+def test_full_mode_keeps_everything_that_fits():
+    packed, info = pack_messages(turns(7), "gpt-4o")
+    assert len(packed) == 7
+    assert info == {"original": 70, "sent": 70, "saved": 0, "dropped": 0}
+
+
+def test_windowed_mode_keeps_the_newest_turns():
+    packed, info = pack_messages(turns(7), "gpt-4o", "windowed")
+    assert [msg["content"].split()[0] for msg in packed] == ["m4", "m5", "m6"]
+    assert info == {"original": 70, "sent": 30, "saved": 40, "dropped": 4}
+
+
+def test_window_opens_on_a_user_message():
+    messages = turns(7)
+    messages[4]["content"] = " ".join(["m4"] * 20)
+    packed, _ = pack_messages(messages, "gpt-4o", "windowed")
+    # m5 and m6 fit, but m5 is an assistant reply without its question
+    assert [msg["content"].split()[0] for msg in packed] == ["m6"]
+
+
+def test_latest_message_is_always_sent():
+    packed, info = pack_messages(turns(1, size=100), "gpt-4o", "windowed")
+    assert len(packed) == 1
+    assert info["sent"] == 100
+
+
+def test_images_are_dropped_from_older_turns():
+    image = {"type": "image_ref", "blob": "abc", "mime": "image/png"}
+    messages = [
+        {"role": "user", "content": [{"type": "text", "text": "first"}, image]},
+        {"role": "assistant", "content": "ok"},
+        {"role": "user", "content": [{"type": "text", "text": "second"}, image]},
+    ]
+    packed, _ = pack_messages(messages, "gpt-4o", "windowed")
+    assert packed[0]["content"][1] == history.IMAGE_PLACEHOLDER
+    assert packed[2]["content"][1] == image
+
+
+def test_system_prompt_comes_first_and_counts():
+    packed, info = pack_messages(turns(7), "gpt-4o", "windowed", system="be brief please")
+    assert packed[0] == {"role": "system", "content": "be brief please"}
+    assert info["sent"] <= 35
+
+
+def test_summary_replaces_the_dropped_span():
+    spans = []
+
+    def summarize(span):
+        spans.append(span)
+        return "short summary"
+
+    packed, info = pack_messages(turns(7), "gpt-4o", "summarized", summarize=summarize, system="sys")
+    assert packed[0]["content"] == "sys"
+    assert packed[1]["role"] == "system" and packed[1]["content"].endswith("short summary")
+    # The window leaves SUMMARY_RESERVE_TOKENS for the summary: 35 - 1 - 10 = 24 tokens of turns
+    assert [msg["content"].split()[0] for msg in packed[2:]] == ["m6"]
+    assert [msg["content"].split()[0] for msg in spans[0]] == ["m0", "m1", "m2", "m3", "m4", "m5"]
+    assert info["sent"] == tokens(packed) <= 35
+
+
+def test_oversized_summary_is_trimmed_to_the_budget():
+    messages = turns(7, size=5)
+
+    def summarize(span):
+        return " ".join(["s"] * 20)
+
+    packed, info = pack_messages(messages, "gpt-4o", "summarized", summarize=summarize)
+    assert info["sent"] == tokens(packed) <= 35
+    assert packed[-1]["content"].startswith("m6")
+
+
+def test_summaries_are_incremental():
+    calls = []
+
+    def summarize(span):
+        calls.append(span)
+        return f"summary of {len(span)}"
+
+    summaries = {}
+    messages = turns(7)
+    pack_messages(messages, "gpt-4o", "summarized", summarize=summarize, summaries=summaries)
+    pack_messages(messages + turns(2), "gpt-4o", "summarized", summarize=summarize, summaries=summaries)
+    assert len(calls) == 2
+    # The second call folds only the newly dropped turns into the previous summary
+    assert calls[1][0]["content"].endswith("summary of 6")
+    assert [msg["content"].split()[0] for msg in calls[1][1:]] == ["m6"]
+
+    # The same history again is served from the cache
+    pack_messages(messages, "gpt-4o", "summarized", summarize=summarize, summaries=summaries)
+    assert len(calls) == 2
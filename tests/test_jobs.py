@@ -0,0 +1,66 @@
+import threading
+import time
+
+import jobs
+from jobs import JobManager, finish_image_message, resolve_jobs
+
+
+def image_message(job_ids, images=()):
+    return {"role": "assistant", "content": list(images), "is_image": True, "images": list(images), "jobs": job_ids}
+
+
+def test_resolve_jobs(store, monkeypatch):
+    store.set_job("alice", "done", "done", result=["b"])
+    store.set_job("alice", "failed", "error", error="content policy")
+    store.set_job("alice", "running", "running")
+    message = image_message(["done", "failed", "running"], images=["a"])
+
+    assert resolve_jobs(store, message) == ["running"]
+    assert message["content"] == ["a", "b"]
+    assert message["errors"] == ["content policy"]
+
+    # A job that stops updating is reported as failed rather than polled forever
+    monkeypatch.setattr(jobs, "JOB_TIMEOUT", -1)
+    assert resolve_jobs(store, message) == []
+    assert message["errors"] == ["content policy", "Image generation did not finish."]
+
+
+def test_missing_job_has_expired(store):
+    message = image_message(["gone"])
+    assert resolve_jobs(store, message) == []
+    assert message["content"] == []
+    assert message["errors"] == ["Image job expired before its result was saved."]
+
+
+def test_finish_image_message(store):
+    store.set_job("alice", "j1", "done", result=["b"])
+    store.append_message("alice", "s1", {"role": "user", "content": "draw"})
+    store.append_message("alice", "s1", image_message(["j1"], images=["a"]))
+
+    message = store.load_messages("alice", "s1")[1]
+    assert resolve_jobs(store, message) == []
+    store.update_message("alice", "s1", 1, finish_image_message(message))
+
+    saved = store.load_messages("alice", "s1")
+    assert saved[0] == {"role": "user", "content": "draw"}
+    assert saved[1] == {"role": "assistant", "content": ["a", "b"], "is_image": True, "errors": []}
+
+
+def test_job_manager_per_user_limit(store):
+    manager = JobManager(store, max_workers=4, per_user=1)
+    release = threading.Event()
+    job_ids = [manager.submit("alice", release.wait, 5) for _ in range(2)]
+    other = manager.submit("bob", lambda: ["x"])
+
+    deadline = time.time() + 5
+    while store.get_jobs([other]).get(other, {}).get("status") != "done" and time.time() < deadline:
+        time.sleep(0.01)
+    statuses = {job_id: job["status"] for job_id, job in store.get_jobs(job_ids).items()}
+    # Bob is not held up by Alice's queue, and Alice runs one job at a time
+    assert store.get_jobs([other])[other]["result"] == ["x"]
+    assert sorted(statuses.values()) == ["queued", "running"]
+
+    release.set()
+    while any(j["status"] != "done" for j in store.get_jobs(job_ids).values()) and time.time() < deadline:
+        time.sleep(0.01)
+    assert all(j["status"] == "done" for j in store.get_jobs(job_ids).values())
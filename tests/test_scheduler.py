@@ -0,0 +1,168 @@
+import threading
+import time
+
+import pytest
+
+import scheduler
+from scheduler import ProviderScheduler, RATE_LIMIT_RETRIES
+from utils import _note_rate_limit
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+class Response:
+    def __init__(self, status_code, retry_after=None):
+        self.status_code = status_code
+        self.headers = {"retry-after": retry_after} if retry_after is not None else {}
+
+
+@pytest.fixture
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(scheduler, "BACKOFF_BASE", 0.01)
+
+
+def make_scheduler(limit=1):
+    s = ProviderScheduler("test", 10_000, 10_000_000)
+    s.limit = limit
+    return s
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def test_fair_queuing_across_users():
+    s = make_scheduler()
+    order = []
+
+    def request(username, name):
+        with s.admit(username):
+            order.append(name)
+
+    with s.admit("alice"):
+        threads = []
+        for name, username in [("a1", "alice"), ("a2", "alice"), ("a3", "alice"), ("b1", "bob")]:
+            thread = threading.Thread(target=request, args=(username, name))
+            thread.start()
+            threads.append(thread)
+            wait_until(lambda: len(s.waiting) == len(threads))
+    for thread in threads:
+        thread.join()
+    # Bob's single request is not stuck behind Alice's backlog
+    assert order == ["a1", "b1", "a2", "a3"]
+
+
+def test_aimd_concurrency():
+    s = make_scheduler(limit=4)
+    with s.admit("alice"):
+        pass
+    assert s.limit == pytest.approx(4.25)
+    s.throttle(0)
+    assert s.limit == pytest.approx(2.125)
+    for _ in range(3):
+        s.throttle(0)
+    assert s.limit == 1.0
+
+
+def test_retry_after_pauses_the_provider(fast_backoff):
+    s = make_scheduler(limit=4)
+    calls = []
+
+    def fn():
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            _note_rate_limit(Response(429, "0.2"))
+            raise StatusError(429)
+        return "ok"
+
+    with s.admit("alice") as lease:
+        assert lease.call(fn) == "ok"
+    assert calls[1] - calls[0] >= 0.2
+    assert s.stats["throttled"] == 1
+    # A throttled request does not grow the limit
+    assert s.limit == pytest.approx(2.0)
+
+
+def test_one_retry_budget(fast_backoff):
+    s = make_scheduler()
+    calls = []
+
+    def rate_limited():
+        calls.append(1)
+        raise StatusError(429)
+
+    with pytest.raises(StatusError), s.admit("alice") as lease:
+        lease.call(rate_limited)
+    assert len(calls) == RATE_LIMIT_RETRIES + 1
+    assert s.active == 0
+
+    def bad_request():
+        calls.append(1)
+        raise StatusError(400)
+
+    calls.clear()
+    with pytest.raises(StatusError), s.admit("alice") as lease:
+        lease.call(bad_request)
+    assert len(calls) == 1
+
+
+def test_backoff_gives_up_the_slot(monkeypatch):
+    monkeypatch.setattr(scheduler, "BACKOFF_BASE", 0.3)
+    s = make_scheduler()
+    failed, events = threading.Event(), []
+
+    def flaky():
+        events.append("alice call")
+        if len(events) == 1:
+            failed.set()
+            raise StatusError(503)
+        return "ok"
+
+    def other():
+        failed.wait()
+        with s.admit("bob"):
+            events.append("bob admitted")
+
+    thread = threading.Thread(target=other)
+    thread.start()
+    with s.admit("alice") as lease:
+        assert lease.call(flaky) == "ok"
+    thread.join()
+    assert events == ["alice call", "bob admitted", "alice call"]
+    assert s.active == 0
+
+
+def test_on_wait_runs_without_the_lock():
+    s = make_scheduler()
+    positions, lock_free = [], []
+
+    def probe():
+        # Another thread can take the lock while on_wait runs
+        if acquired := s.cond.acquire(timeout=1):
+            s.cond.release()
+        lock_free.append(acquired)
+
+    def on_wait(position):
+        positions.append(position)
+        thread = threading.Thread(target=probe)
+        thread.start()
+        thread.join()
+
+    def request():
+        with s.admit("bob", on_wait=on_wait):
+            pass
+
+    with s.admit("alice"):
+        thread = threading.Thread(target=request)
+        thread.start()
+        wait_until(lambda: positions)
+    thread.join()
+    assert positions == [1]
+    assert lock_free == [True]
@@ -0,0 +1,149 @@
+import pytest
+
+from store import JOB_RETENTION, RedisStore, SessionStore, SQLiteStore
+
+
+@pytest.fixture
+def sqlite_store(tmp_path):
+    return SQLiteStore(str(tmp_path / "chatterlit.db"))
+
+
+def text(role, value):
+    return {"role": role, "content": [{"type": "text", "text": value}]}
+
+
+def test_append_and_load(store):
+    store.append_message("alice", "s1", text("user", "hello zookeeper"))
+    store.append_message("alice", "s1", {"role": "assistant", "content": "hi", "stats": {"tokens": 3}})
+    store.append_message("alice", "s2", text("user", "second session"))
+    store.append_message("bob", "s1", text("user", "not alice"))
+
+    messages = store.load_messages("alice", "s1")
+    assert [m["role"] for m in messages] == ["user", "assistant"]
+    assert messages[1]["stats"] == {"tokens": 3}
+    assert store.load_messages("alice", "missing") == []
+
+
+def test_list_sessions_and_title(store):
+    store.append_message("alice", "2026-01-01 10:00:00", text("user", "first"))
+    store.append_message("alice", "2026-01-02 10:00:00", text("user", "second"))
+    store.set_title("alice", "2026-01-01 10:00:00", "First chat")
+
+    sessions = store.list_sessions("alice")
+    assert [s["session_id"] for s in sessions] == ["2026-01-02 10:00:00", "2026-01-01 10:00:00"]
+    assert sessions[1]["title"] == "First chat"
+    assert sessions[0]["updated"] >= sessions[0]["created"]
+    assert store.list_sessions("bob") == []
+
+
+def test_bytes_round_trip(store):
+    store.append_message("alice", "s1", {"role": "assistant", "content": [b"\x89PNG"], "is_image": True})
+    assert store.load_messages("alice", "s1")[0]["content"] == [b"\x89PNG"]
+
+
+def test_session_store_is_abstract():
+    with pytest.raises(TypeError):
+        SessionStore()
+
+
+def test_update_message(store):
+    store.append_message("alice", "s1", text("user", "draw"))
+    store.append_message("alice", "s1", {"role": "assistant", "content": [], "is_image": True, "jobs": ["j1"]})
+    store.update_message("alice", "s1", 1, {"role": "assistant", "content": ["ref"], "is_image": True})
+
+    messages = store.load_messages("alice", "s1")
+    assert messages[0]["content"][0]["text"] == "draw"
+    assert messages[1] == {"role": "assistant", "content": ["ref"], "is_image": True}
+
+
+def test_jobs(store):
+    store.set_job("alice", "j1", "queued")
+    store.set_job("alice", "j2", "queued")
+    store.set_job("alice", "j1", "done", result=[{"type": "image_ref", "blob": "abc"}])
+    store.set_job("alice", "j2", "error", error="content policy")
+
+    jobs = store.get_jobs(["j1", "j2", "missing"])
+    assert set(jobs) == {"j1", "j2"}
+    assert jobs["j1"]["status"] == "done"
+    assert jobs["j1"]["result"] == [{"type": "image_ref", "blob": "abc"}]
+    assert jobs["j1"]["error"] is None
+    assert jobs["j2"]["status"] == "error"
+    assert jobs["j2"]["error"] == "content policy"
+    assert isinstance(jobs["j2"]["updated"], float)
+
+
+@pytest.fixture(params=["sqlite", "sqlite-like", "redis"])
+def search_store(request, tmp_path, redis_client):
+    if request.param == "redis":
+        return RedisStore(redis_client)
+    store = SQLiteStore(str(tmp_path / "chatterlit.db"))
+    # The LIKE scan is the fallback for SQLite builds without FTS5
+    store.fts = request.param == "sqlite"
+    return store
+
+
+def test_search(search_store):
+    store = search_store
+    store.append_message("alice", "s1", text("user", "tell me about the zookeeper"))
+    store.append_message("alice", "s1", {"role": "assistant", "content": "Penguins need cold water."})
+    store.append_message("alice", "s2", text("user", "unrelated"))
+    store.append_message("bob", "s3", text("user", "zookeeper for bob"))
+    store.set_title("alice", "s1", "Zoo")
+
+    hits = store.search("alice", "zookeeper")
+    assert [(h["session_id"], h["seq"], h["role"]) for h in hits] == [("s1", 0, "user")]
+    assert hits[0]["title"] == "Zoo"
+    assert "zookeeper" in hits[0]["snippet"]
+    assert store.search("alice", "   ") == []
+    assert store.search("alice", "nothing matches") == []
+
+
+def test_search_ignores_message_structure(search_store):
+    search_store.append_message("alice", "s1", text("user", "hello"))
+    for query in ("role", "content", "text", "user"):
+        assert search_store.search("alice", query) == []
+
+
+def test_search_compare_answers(search_store):
+    search_store.append_message("alice", "s1", {
+        "role": "assistant", "content": "",
+        "compare": [{"model": "m", "content": "a giraffe answer"}],
+    })
+    assert [h["seq"] for h in search_store.search("alice", "giraffe")] == [0]
+
+
+def test_like_wildcards_are_literal(sqlite_store):
+    store = sqlite_store
+    store.fts = False
+    store.append_message("alice", "s1", text("user", "100% sure"))
+    store.append_message("alice", "s1", text("user", "1000 sure"))
+    store.append_message("alice", "s1", text("user", "snake_case"))
+    store.append_message("alice", "s1", text("user", "snakeXcase"))
+    assert [h["seq"] for h in store.search("alice", "0%")] == [0]
+    assert [h["seq"] for h in store.search("alice", "e_c")] == [2]
+
+
+def test_update_message_is_reindexed(search_store):
+    store = search_store
+    store.append_message("alice", "s1", text("user", "old words"))
+    store.update_message("alice", "s1", 0, text("user", "new words"))
+    assert store.search("alice", "old") == []
+    assert [h["seq"] for h in store.search("alice", "new")] == [0]
+
+
+def test_state(store):
+    assert store.get_state("alice", "current_session") is None
+    assert store.get_state("alice", "current_session", "default") == "default"
+    store.set_state("alice", "current_session", "s1")
+    store.set_state("alice", "generating", {"s1": 1.5})
+    assert store.get_state("alice", "current_session") == "s1"
+    assert store.get_state("alice", "generating") == {"s1": 1.5}
+    assert store.get_state("bob", "current_session") is None
+
+    store.set_state("alice", "generating", None)
+    assert store.get_state("alice", "generating") is None
+
+
+def test_redis_jobs_expire(redis_client):
+    RedisStore(redis_client).set_job("alice", "j1", "queued")
+    assert 0 < redis_client.ttl("chatterlit:job:j1") <= JOB_RETENTION
@@ -0,0 +1,73 @@
+import threading
+from collections import defaultdict, deque
+
+import pytest
+
+import telemetry
+from telemetry import aggregates, export_prometheus, track
+
+
+@pytest.fixture(autouse=True)
+def fresh_telemetry(tmp_path, monkeypatch):
+    monkeypatch.setenv("CHATTERLIT_TELEMETRY_LOG", str(tmp_path / "requests.jsonl"))
+    monkeypatch.setattr(telemetry, "PROMETHEUS_FILE", None)
+    monkeypatch.setattr(telemetry, "_logger", None)
+    monkeypatch.setattr(telemetry, "_replayed", False)
+    monkeypatch.setattr(telemetry, "_recent", defaultdict(lambda: deque(maxlen=telemetry.WINDOW)))
+    monkeypatch.setattr(telemetry, "_totals", defaultdict(lambda: {
+        "requests": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0,
+    }))
+    yield
+    if telemetry._logger is not None:
+        for handler in list(telemetry._logger.handlers):
+            telemetry._logger.removeHandler(handler)
+            handler.close()
+
+
+def test_track_records_the_event(tmp_path):
+    with track("chat", "gpt-4o-mini", "alice") as event:
+        event.update({"prompt_tokens": 10, "completion_tokens": 5})
+    with pytest.raises(RuntimeError), track("chat", "gpt-4o-mini", "alice"):
+        raise RuntimeError("boom")
+
+    (row,) = aggregates()
+    assert (row["requests"], row["errors"], row["prompt_tokens"]) == (2, 1, 10)
+    assert len((tmp_path / "requests.jsonl").read_text().splitlines()) == 2
+
+
+def test_recording_errors_do_not_fail_the_request(tmp_path):
+    # A directory where the log file should be: the handler cannot open it
+    (tmp_path / "requests.jsonl").mkdir()
+    with track("chat", "gpt-4o-mini") as event:
+        event["completion_tokens"] = 1
+    assert event["status"] == "ok"
+
+
+def test_concurrent_prometheus_exports(tmp_path, monkeypatch):
+    path = tmp_path / "chatterlit.prom"
+    monkeypatch.setattr(telemetry, "PROMETHEUS_FILE", str(path))
+    errors = []
+
+    def run():
+        try:
+            for _ in range(20):
+                with track("map", "gpt-4o-mini"):
+                    pass
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert 'chatterlit_requests_total{kind="map",model="gpt-4o-mini"} 160' in path.read_text()
+    assert [p.name for p in tmp_path.iterdir() if p.name.endswith(".tmp")] == []
+
+
+def test_export_is_readable_by_the_collector(tmp_path):
+    path = tmp_path / "chatterlit.prom"
+    export_prometheus(str(path))
+    assert path.stat().st_mode & 0o044 == 0o044
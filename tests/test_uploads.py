@@ -0,0 +1,102 @@
+import io
+from collections import OrderedDict
+
+import pytest
+
+import uploads
+from uploads import preprocess_upload, read_text, strip_latex
+
+
+class Upload(io.BytesIO):
+    """Stand-in for Streamlit's UploadedFile."""
+
+    def __init__(self, data, name, type="text/plain"):
+        super().__init__(data)
+        self.name, self.type, self.size = name, type, len(data)
+
+
+@pytest.fixture(autouse=True)
+def fresh_memo(monkeypatch, tmp_path):
+    monkeypatch.setattr(uploads, "_processed", OrderedDict())
+    monkeypatch.setattr(uploads, "_processed_bytes", 0)
+    monkeypatch.setenv("CHATTERLIT_BLOBS", str(tmp_path / "blobs"))
+    uploads.get_blob_store.cache_clear()
+    yield
+    uploads.get_blob_store.cache_clear()
+
+
+def test_read_text_within_the_limit():
+    assert read_text(Upload(b"hello", "a.txt")) == "hello"
+
+
+def test_read_text_truncates(monkeypatch):
+    monkeypatch.setattr(uploads, "CHUNK_SIZE", 4)
+    text = read_text(Upload(b"0123456789", "a.txt"), limit=6)
+    assert text == "012345\n\n[truncated after 6 bytes]"
+
+
+def test_read_text_drops_a_split_character():
+    # The cut lands inside a two-byte character
+    assert read_text(Upload("aé".encode(), "a.txt"), limit=2).startswith("a\n\n[truncated")
+
+
+def test_strip_latex():
+    source = r"""\documentclass{article}
+\usepackage{amsmath}
+\begin{document}
+\maketitle
+Results are 50\% better. % TODO check this
+
+
+\section{Intro}
+Text.
+\end{document}
+"""
+    assert strip_latex(source) == "Results are 50\\% better. \n\n\\section{Intro}\nText."
+    assert strip_latex("no body % comment") == "no body"
+
+
+def test_text_uploads():
+    assert preprocess_upload(Upload(b"notes", "a.txt")) == [{"type": "text", "text": "notes"}]
+    tex = rb"\begin{document}Hi % x" + b"\n" + rb"\end{document}"
+    assert preprocess_upload(Upload(tex, "a.tex")) == [{"type": "text", "text": "Hi"}]
+    assert preprocess_upload(Upload(b"data", "a.bin", "application/octet-stream")) == []
+
+
+def test_oversize_upload_is_rejected(monkeypatch):
+    monkeypatch.setattr(uploads, "MAX_UPLOAD_BYTES", 3)
+    with pytest.raises(ValueError, match="a.txt"):
+        preprocess_upload(Upload(b"too big", "a.txt"))
+
+
+def test_memo_reuses_processed_uploads(monkeypatch):
+    calls = []
+    process = uploads._process
+    monkeypatch.setattr(uploads, "_process", lambda *args: calls.append(args) or process(*args))
+
+    first = preprocess_upload(Upload(b"notes", "a.txt"))
+    assert preprocess_upload(Upload(b"notes", "a.txt")) is first
+    preprocess_upload(Upload(b"notes", "a.txt"), text_limit=3)
+    preprocess_upload(Upload(b"other", "a.txt"))
+    assert len(calls) == 3
+
+
+def test_memo_is_bounded_by_bytes(monkeypatch):
+    monkeypatch.setattr(uploads, "PROCESSED_MAX_BYTES", 10)
+    for name in ("a", "b", "c"):
+        preprocess_upload(Upload(name.encode() * 4, f"{name}.txt"))
+    assert uploads._processed_bytes == 8
+    assert [key[1] for key in uploads._processed] == ["b.txt", "c.txt"]
+    # Parts bigger than the whole memo are never kept
+    preprocess_upload(Upload(b"x" * 11, "big.txt"))
+    assert "big.txt" not in [key[1] for key in uploads._processed]
+
+
+def test_images_are_downscaled():
+    Image = pytest.importorskip("PIL.Image")
+    out = io.BytesIO()
+    Image.new("RGB", (4000, 1000), "white").save(out, "PNG")
+    (part,) = preprocess_upload(Upload(out.getvalue(), "wide.png", "image/png"), "gpt-4o")
+    assert part["type"] == "image_ref" and part["mime"] == "image/jpeg"
+    with Image.open(io.BytesIO(uploads.get_blob_store().read(part["blob"]))) as img:
+        assert img.size == (2048, 512)
@@ -0,0 +1,106 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import utils
+from utils import extract_delta, message_token_counts, stream_reply, text_lru_cache
+
+
+def test_text_lru_cache_keys_on_a_digest():
+    calls = []
+
+    @text_lru_cache(maxsize=2)
+    def length(text, scale):
+        calls.append(text)
+        return len(text) * scale
+
+    big = "x" * 100_000
+    assert length(big, 1) == 100_000
+    assert length("x" * 100_000, 1) == 100_000  # equal text, different object
+    assert length(big, 2) == 200_000
+    assert len(calls) == 2
+
+    length("a", 1)
+    length(big, 1)  # evicted as least recently used
+    assert len(calls) == 4
+    length.cache_clear()
+    length("a", 1)
+    assert len(calls) == 5
+
+
+def test_message_token_counts_only_counts_new_messages(monkeypatch):
+    counted = []
+    monkeypatch.setattr(utils, "count_tokens", lambda msg, model: counted.append(msg) or len(msg["content"]))
+    messages = [{"role": "user", "content": "abc"}, {"role": "assistant", "content": "de"}]
+    counts = message_token_counts([], messages, "gpt-4o")
+    assert counts == [3, 2]
+
+    messages.append({"role": "user", "content": "f"})
+    assert message_token_counts(counts, messages, "gpt-4o") == [3, 2, 1]
+    assert len(counted) == 3
+
+
+def test_connection_stats_from_many_threads():
+    before = utils.connection_stats()
+
+    def run():
+        for _ in range(2000):
+            utils._trace("connection.connect_tcp.complete", {})
+            for _ in range(3):
+                utils._trace("http11.send_request_headers.started", {})
+
+    threads = [threading.Thread(target=run) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    after = utils.connection_stats()
+    assert after["connections_opened"] - before["connections_opened"] == 16000
+    assert after["requests"] - before["requests"] == 48000
+    assert after["connections_reused"] - before["connections_reused"] == 32000
+
+
+def chunk(content=None, usage=None):
+    choices = [] if content is None else [SimpleNamespace(delta=SimpleNamespace(content=content))]
+    return SimpleNamespace(choices=choices, usage=usage)
+
+
+def test_extract_delta():
+    assert extract_delta(chunk("hi")) == "hi"
+    assert extract_delta(chunk()) is None
+    assert extract_delta(SimpleNamespace(choices=[SimpleNamespace(delta=None, text="legacy")])) == "legacy"
+    assert extract_delta({"choices": [{"delta": {"content": "dict"}}]}) == "dict"
+    assert extract_delta({"choices": [{"text": "completion"}]}) == "completion"
+    assert extract_delta({"choices": []}) is None
+
+
+def fake_clock(monkeypatch, *times):
+    ticks = iter(times)
+    monkeypatch.setattr(utils.time, "perf_counter", lambda: next(ticks))
+
+
+def test_stream_reply_uses_the_usage_chunk(monkeypatch):
+    usage = SimpleNamespace(prompt_tokens=20, completion_tokens=10,
+                            prompt_tokens_details=SimpleNamespace(cached_tokens=8))
+    stream = [chunk(""), chunk("Hel"), chunk("lo"), chunk(usage=usage)]
+    # First delta at 0.5s, stream exhausted at 2.5s
+    fake_clock(monkeypatch, 10.5, 12.5)
+    stats = {}
+    assert "".join(stream_reply(stream, "gpt-4o", stats, started=10.0)) == "Hello"
+    assert stats["ttft"] == pytest.approx(0.5)
+    assert stats["elapsed"] == pytest.approx(2.5)
+    assert stats["completion_tokens"] == 10
+    assert stats["tokens_per_sec"] == pytest.approx(5.0)
+    assert (stats["prompt_tokens"], stats["cached_tokens"]) == (20, 8)
+
+
+def test_stream_reply_counts_tokens_without_usage(monkeypatch):
+    monkeypatch.setattr(utils, "count_tokens", lambda message, model: len(message["content"].split()))
+    fake_clock(monkeypatch, 1.0, 1.0, 3.0)
+    stats = {}
+    assert list(stream_reply([chunk("one "), chunk("two three")], "gpt-4o", stats)) == ["one ", "two three"]
+    assert stats["ttft"] == 0.0
+    assert stats["completion_tokens"] == 3
+    assert stats["tokens_per_sec"] == pytest.approx(1.5)
+    assert "prompt_tokens" not in stats
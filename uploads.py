@@ -0,0 +1,150 @@
+# uploads.py
+import hashlib
+import io
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from blobs import get_blob_store, image_ref
+from models import IMAGE_TARGETS, DEFAULT_IMAGE_TARGET
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; images are then sent as uploaded
+    Image = None
+
+MAX_UPLOAD_BYTES = int(os.getenv("CHATTERLIT_MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+MAX_TEXT_BYTES = int(os.getenv("CHATTERLIT_MAX_TEXT_BYTES", str(2 * 1024 * 1024)))
+# Text cap when uploads go through large-document map-reduce (documents.py)
+MAX_DOCUMENT_BYTES = int(os.getenv("CHATTERLIT_MAX_DOCUMENT_BYTES", str(16 * 1024 * 1024)))
+JPEG_QUALITY = int(os.getenv("CHATTERLIT_JPEG_QUALITY", "85"))
+CHUNK_SIZE = 64 * 1024
+
+# Processed parts by (sha256 of upload, name, target); re-attached files are not reprocessed.
+# Shared by every script thread, LRU-bounded by the size of the text parts it holds
+# (image parts are small blob references).
+PROCESSED_MAX_BYTES = int(os.getenv("CHATTERLIT_UPLOAD_MEMO_BYTES", str(32 * 1024 * 1024)))
+_processed = OrderedDict()
+_processed_bytes = 0
+_processed_lock = threading.Lock()
+
+
+def image_target(model):
+    for prefix, target in IMAGE_TARGETS.items():
+        if model and model.startswith(prefix):
+            return target
+    return DEFAULT_IMAGE_TARGET
+
+
+def _fit(width, height, target):
+    # Scale down so the long side fits target[0] and the short side fits target[1]
+    max_long, max_short = target
+    scale = min(1.0, max_long / max(width, height), max_short / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def prepare_image(data, mime, target):
+    """Downscale and recompress an image; returns (bytes, mime).
+
+    Opaque images become JPEG, images with transparency stay PNG. Without
+    Pillow, or if the image can't be decoded, the original is returned.
+    """
+    if Image is None:
+        return data, mime
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img = ImageOps.exif_transpose(img)
+            size = _fit(img.width, img.height, target)
+            if size != (img.width, img.height):
+                img = img.resize(size, Image.LANCZOS)
+            out = io.BytesIO()
+            if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+                img.save(out, "PNG", optimize=True)
+                result = out.getvalue(), "image/png"
+            else:
+                img.convert("RGB").save(out, "JPEG", quality=JPEG_QUALITY, optimize=True)
+                result = out.getvalue(), "image/jpeg"
+    except Exception:
+        return data, mime
+    # Never replace an upload with something larger
+    return result if len(result[0]) < len(data) else (data, mime)
+
+
+def read_text(file, limit=None):
+    """Read at most `limit` (default MAX_TEXT_BYTES) bytes of a text upload in chunks."""
+    limit = limit or MAX_TEXT_BYTES
+    file.seek(0)
+    chunks, size = [], 0
+    while size < limit:
+        chunk = file.read(min(CHUNK_SIZE, limit - size))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size += len(chunk)
+    truncated = bool(file.read(1))
+    text = b"".join(chunks).decode("utf-8", errors="ignore")
+    if truncated:
+        text += f"\n\n[truncated after {limit} bytes]"
+    return text
+
+
+def strip_latex(text):
+    """Keep the document body of a .tex file without comments or preamble."""
+    body = re.search(r"\\begin\{document\}(.*?)\\end\{document\}", text, re.S)
+    if body:
+        text = body.group(1)
+    # Drop % comments but keep escaped \%
+    text = re.sub(r"(?<!\\)%.*", "", text)
+    text = re.sub(r"\\(maketitle|tableofcontents|newpage|clearpage)\b", "", text)
+    return re.sub(r"\n\s*\n+", "\n\n", text).strip()
+
+
+def _file_digest(file):
+    file.seek(0)
+    h = hashlib.sha256()
+    while chunk := file.read(CHUNK_SIZE):
+        h.update(chunk)
+    file.seek(0)
+    return h.hexdigest()
+
+
+def _process(file, target, text_limit=None):
+    if file.type and file.type.startswith("image/"):
+        if Image is None:
+            # Nothing to downscale with: hash and copy the upload in chunks
+            return [image_ref(get_blob_store().put_file(file), file.type)]
+        file.seek(0)
+        data, mime = prepare_image(file.read(), file.type, target)
+        return [image_ref(get_blob_store().put(data), mime)]
+    if file.name.endswith(".tex"):
+        return [{"type": "text", "text": strip_latex(read_text(file, text_limit))}]
+    if file.name.endswith(".txt"):
+        return [{"type": "text", "text": read_text(file, text_limit)}]
+    return []
+
+
+def preprocess_upload(file, model=None, text_limit=None):
+    """Content parts for one uploaded file, memoized by content hash.
+
+    Text is cut at `text_limit` bytes (default MAX_TEXT_BYTES).
+    """
+    if getattr(file, "size", 0) > MAX_UPLOAD_BYTES:
+        raise ValueError(f"{file.name} is larger than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB")
+    global _processed_bytes
+    target = image_target(model)
+    key = (_file_digest(file), file.name, target, text_limit)
+    with _processed_lock:
+        if key in _processed:
+            _processed.move_to_end(key)
+            return _processed[key][0]
+    parts = _process(file, target, text_limit)
+    size = sum(len(part.get("text", "")) for part in parts)
+    with _processed_lock:
+        if key not in _processed and size <= PROCESSED_MAX_BYTES:
+            _processed[key] = (parts, size)
+            _processed_bytes += size
+            while _processed_bytes > PROCESSED_MAX_BYTES:
+                _, (_, evicted) = _processed.popitem(last=False)
+                _processed_bytes -= evicted
+    return parts
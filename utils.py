@@ -1,31 +1,161 @@
 # utils.py
 import streamlit as st
 import base64
-import tiktoken
+import functools
+import hashlib
+import math
 import os
-from models import MODEL_OPTIONS
-from openai import OpenAI
+import threading
+import time
+from collections import OrderedDict
+from models import MODEL_PRICING
+from blobs import get_blob_store
+from uploads import preprocess_upload
 
-# Tokenizer: always use the current selected_model
-def count_tokens(message, model):
+# Tokenizer: always use the current selected_model.
+# tiktoken and openai are imported on first use to keep module import cheap.
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    import tiktoken
     try:
-        enc = tiktoken.encoding_for_model(model)
+        return tiktoken.encoding_for_model(model)
     except KeyError:
-        enc = tiktoken.get_encoding("cl100k_base")
+        return tiktoken.get_encoding("cl100k_base")
+
+@functools.lru_cache(maxsize=None)
+def _encoding(name):
+    import tiktoken
+    return tiktoken.get_encoding(name)
+
+def text_lru_cache(maxsize):
+    """lru_cache for fn(text, *args), keyed by a sha256 of the text instead of the text.
+
+    Uploaded documents can be megabytes each; keying on the text itself would
+    keep every one of them alive for the life of the process.
+    """
+    def decorator(fn):
+        entries = OrderedDict()
+        lock = threading.Lock()
+
+        @functools.wraps(fn)
+        def wrapper(text, *args):
+            key = (hashlib.sha256(text.encode()).digest(),) + args
+            with lock:
+                if key in entries:
+                    entries.move_to_end(key)
+                    return entries[key]
+            value = fn(text, *args)
+            with lock:
+                entries[key] = value
+                if len(entries) > maxsize:
+                    entries.popitem(last=False)
+            return value
+
+        wrapper.cache_clear = entries.clear
+        return wrapper
+    return decorator
+
+@text_lru_cache(maxsize=2048)
+def _text_tokens(text, encoding_name):
+    return len(_encoding(encoding_name).encode(text, disallowed_special=()))
+
+def prewarm_encodings(models):
+    # Load BPE files up front so the first rerun doesn't pay for them
+    for model in models:
+        try:
+            get_encoding(model)
+        except Exception:
+            pass
+
+# OpenAI vision pricing: 85 base tokens + 170 per 512px tile after scaling
+# to fit 2048x2048 and then 768px on the short side.
+IMAGE_BASE_TOKENS = 85
+IMAGE_TILE_TOKENS = 170
+IMAGE_DEFAULT_TOKENS = IMAGE_BASE_TOKENS + 4 * IMAGE_TILE_TOKENS
+
+def _image_size(data):
+    # Read width/height from PNG or JPEG headers without a full decode
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+        return int.from_bytes(data[16:20], "big"), int.from_bytes(data[20:24], "big")
+    if data[:2] == b"\xff\xd8":
+        i = 2
+        while i + 9 < len(data):
+            if data[i] != 0xFF:
+                i += 1
+                continue
+            marker = data[i + 1]
+            length = int.from_bytes(data[i + 2:i + 4], "big")
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                return int.from_bytes(data[i + 7:i + 9], "big"), int.from_bytes(data[i + 5:i + 7], "big")
+            i += 2 + length
+    return None
+
+def image_tokens_for_size(size, detail="auto"):
+    if detail == "low":
+        return IMAGE_BASE_TOKENS
+    if not size:
+        return IMAGE_DEFAULT_TOKENS
+    width, height = size
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return IMAGE_BASE_TOKENS + IMAGE_TILE_TOKENS * tiles
+
+@functools.lru_cache(maxsize=256)
+def image_tokens(url, detail="auto"):
+    size = None
+    if url.startswith("data:") and "," in url:
+        try:
+            size = _image_size(base64.b64decode(url.split(",", 1)[1]))
+        except Exception:
+            size = None
+    return image_tokens_for_size(size, detail)
+
+@functools.lru_cache(maxsize=4096)
+def blob_image_tokens(digest):
+    # JPEG headers can sit behind EXIF data, so read a generous prefix
+    try:
+        size = _image_size(get_blob_store().read(digest, 256 * 1024))
+    except OSError:
+        size = None
+    return image_tokens_for_size(size)
+
+def count_tokens(message, model):
+    encoding_name = get_encoding(model).name
 
     if isinstance(message["content"], str):
         # Standard text-only messages
-        return len(enc.encode(message["content"]))
+        return _text_tokens(message["content"], encoding_name)
 
     elif isinstance(message["content"], list):
-        # Multimodal: count only the text parts
+        # Multimodal: text parts are tokenized, image parts are estimated
         token_count = 0
         for part in message["content"]:
             if part["type"] == "text":
-                token_count += len(enc.encode(part["text"]))
+                token_count += _text_tokens(part["text"], encoding_name)
+            elif part["type"] == "image_url":
+                image = part["image_url"]
+                token_count += image_tokens(image["url"], image.get("detail", "auto"))
+            elif part["type"] == "image_ref":
+                token_count += blob_image_tokens(part["blob"])
         return token_count
 
-    return 0 
+    return 0
+
+def message_token_counts(counts, messages, model):
+    """Extend `counts` (a per-session list parallel to `messages`) in place.
+
+    Messages are append-only, so only the new tail is tokenized on a rerun.
+    """
+    for msg in messages[len(counts):]:
+        try:
+            counts.append(count_tokens(msg, model))
+        except Exception:
+            # If the token counter fails, fallback to 0
+            counts.append(0)
+    return counts
 
 
 def get_content(message):
@@ -41,39 +171,212 @@ def get_content(message):
 def truncate_message(text, max_length=200):
     return text if len(text) <= max_length else text[:max_length] + "..."
 
-def encode_images(file):
-    return {
-        "type": "image_url",
-        "image_url": {
-            "url": f"data:{file.type};base64,{base64.b64encode(file.read()).decode()}"
-        },
-    }
-
-def process_uploaded_files(files):
+def process_uploaded_files(files, model=None, text_limit=None, strict=False):
+    # Images are downscaled for the model, .tex/.txt become text parts (see uploads.py).
+    # A rejected file is a warning in the UI; strict callers without one (batch.py) get the error.
     content_blocks = []
 
     for file in files:
-        if file.type.startswith("image/"):
-            # Process image
-            content_blocks.append(encode_images(file))
-        elif file.name.endswith(".txt"):
-            # Process txt file
-            text = file.read().decode("utf-8", errors="ignore")
-            content_blocks.append({"type": "text", "text": text})
-    
+        try:
+            content_blocks.extend(preprocess_upload(file, model, text_limit))
+        except ValueError as e:
+            if strict:
+                raise
+            st.warning(str(e))
+
     return content_blocks
 
-def init_client(model):
-    keys = {
-        "grok": ("GROK_API_KEY", "https://api.x.ai/v1"),
-        "gemini": ("GEMINI_API_KEY", "https://generativelanguage.googleapis.com/v1beta/openai/"),
-    }
-    for prefix, (env, url) in keys.items():
+def extract_reply(response):
+    # Try common shapes: choices[0].message.content, choices[0].text, dict access
+    if hasattr(response, "choices"):
+        choice = response.choices[0]
+        if hasattr(choice, "message") and hasattr(choice.message, "content"):
+            return choice.message.content
+        elif hasattr(choice, "text"):
+            return choice.text
+    try:
+        return response["choices"][0]["message"]["content"]
+    except Exception:
+        return str(response)
+
+def extract_delta(chunk):
+    # Streaming counterpart of extract_reply; the final usage chunk has no choices
+    if hasattr(chunk, "choices"):
+        if not chunk.choices:
+            return None
+        choice = chunk.choices[0]
+        if getattr(choice, "delta", None) is not None:
+            return getattr(choice.delta, "content", None)
+        return getattr(choice, "text", None)
+    try:
+        choice = chunk["choices"][0]
+        return choice.get("delta", {}).get("content") or choice.get("text")
+    except Exception:
+        return None
+
+def stream_reply(stream, model, stats, started=None):
+    """Yield text deltas from a streaming completion.
+
+    Timings are written into `stats` once the stream is exhausted: time to
+    first token, total time and completion tokens per second (from the usage
+    chunk when the provider sends one, otherwise counted locally).
+    """
+    started = started or time.perf_counter()
+    parts = []
+    completion_tokens = None
+    for chunk in stream:
+        usage = getattr(chunk, "usage", None)
+        if usage is not None and getattr(usage, "completion_tokens", None):
+            usage_stats(usage, stats)
+            completion_tokens = usage.completion_tokens
+        delta = extract_delta(chunk)
+        if not delta:
+            continue
+        if "ttft" not in stats:
+            stats["ttft"] = time.perf_counter() - started
+        parts.append(delta)
+        yield delta
+
+    elapsed = time.perf_counter() - started
+    if completion_tokens is None:
+        try:
+            completion_tokens = count_tokens({"content": "".join(parts)}, model)
+        except Exception:
+            completion_tokens = len(parts)
+    generation_time = elapsed - stats.get("ttft", 0)
+    stats["elapsed"] = elapsed
+    stats["completion_tokens"] = completion_tokens
+    stats["tokens_per_sec"] = completion_tokens / generation_time if generation_time > 0 else 0.0
+
+def usage_stats(usage, stats):
+    # prompt_tokens_details.cached_tokens is the provider-side prompt cache hit
+    stats["prompt_tokens"] = getattr(usage, "prompt_tokens", None) or 0
+    stats["completion_tokens"] = getattr(usage, "completion_tokens", None) or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    stats["cached_tokens"] = getattr(details, "cached_tokens", None) or 0
+    return stats
+
+def estimate_cost(model, stats):
+    if model not in MODEL_PRICING or "completion_tokens" not in stats:
+        return None
+    input_price, output_price = MODEL_PRICING[model]
+    return (stats.get("prompt_tokens", 0) * input_price + stats["completion_tokens"] * output_price) / 1_000_000
+
+def format_stats(stats):
+    if not stats:
+        return ""
+    pieces = ["⚡ cached"] if stats.get("cached") else []
+    if "ttft" in stats:
+        pieces.append(f"TTFT {stats['ttft']:.2f}s")
+    if "tokens_per_sec" in stats:
+        pieces.append(f"{stats['tokens_per_sec']:.1f} tok/s")
+    if "elapsed" in stats:
+        pieces.append(f"{stats['elapsed']:.1f}s total")
+    if stats.get("prompt_tokens"):
+        cached = stats.get("cached_tokens", 0)
+        pieces.append(f"{cached}/{stats['prompt_tokens']} prompt tokens cached")
+    if stats.get("cost") is not None:
+        pieces.append(f"${stats['cost']:.4f}")
+    if stats.get("history_saved"):
+        pieces.append(f"{stats['history_saved']} history tokens saved")
+    return ", ".join(pieces)
+
+# Process-wide API clients keyed by (base_url, api_key); each owns one pooled
+# httpx client so reruns and model switches reuse warm TLS connections.
+HTTP_TIMEOUT = float(os.getenv("CHATTERLIT_HTTP_TIMEOUT", "600"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("CHATTERLIT_CONNECT_TIMEOUT", "10"))
+# SDK retries for calls made outside the scheduler (e.g. batch.py's Batch API calls)
+HTTP_MAX_RETRIES = int(os.getenv("CHATTERLIT_MAX_RETRIES", "2"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("CHATTERLIT_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("CHATTERLIT_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("CHATTERLIT_KEEPALIVE_EXPIRY", "120"))
+
+_clients = {}
+_clients_lock = threading.Lock()
+client_metrics = {"clients_created": 0, "clients_reused": 0, "requests": 0, "connections_opened": 0}
+# Requests run on compare, job and map worker threads as well as the script thread
+_metrics_lock = threading.Lock()
+
+_local = threading.local()
+
+def _trace(event, info):
+    # httpcore trace hook: a TCP connect means a new connection, headers mean a request
+    if event == "connection.connect_tcp.complete":
+        with _metrics_lock:
+            client_metrics["connections_opened"] += 1
+    elif event.endswith("send_request_headers.started"):
+        with _metrics_lock:
+            client_metrics["requests"] += 1
+        _local.requests = getattr(_local, "requests", 0) + 1
+
+def thread_request_count():
+    # HTTP attempts made by this thread; the difference across a call gives its retries
+    return getattr(_local, "requests", 0)
+
+def _attach_trace(request):
+    request.extensions["trace"] = _trace
+
+def _note_rate_limit(response):
+    # Seen on every attempt, including any the SDK retries by itself
+    if response.status_code == 429:
+        try:
+            _local.rate_limited = float(response.headers.get("retry-after", ""))
+        except ValueError:
+            _local.rate_limited = getattr(_local, "rate_limited", None) or 0.0
+
+def take_rate_limit():
+    # Retry-After (0.0 if absent) of a 429 seen by this thread since the last call, else None
+    retry_after, _local.rate_limited = getattr(_local, "rate_limited", None), None
+    return retry_after
+
+def get_client(api_key, base_url=None):
+    import httpx
+    from openai import OpenAI
+
+    key = (base_url, api_key)
+    with _clients_lock:
+        if key in _clients:
+            with _metrics_lock:
+                client_metrics["clients_reused"] += 1
+            return _clients[key]
+        http_client = httpx.Client(
+            timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            event_hooks={"request": [_attach_trace], "response": [_note_rate_limit]},
+        )
+        # No SDK retries: scheduler.Lease.call retries 408/409/429/5xx itself, so
+        # every attempt is admitted and counted against one budget. Calls made
+        # outside the scheduler use client.with_options(max_retries=HTTP_MAX_RETRIES).
+        client = OpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+        _clients[key] = client
+        with _metrics_lock:
+            client_metrics["clients_created"] += 1
+        return client
+
+def connection_stats():
+    with _metrics_lock:
+        metrics = dict(client_metrics)
+    return {**metrics, "connections_reused": max(metrics["requests"] - metrics["connections_opened"], 0)}
+
+# Provider routing by model prefix: (provider, API key env var, base URL)
+PROVIDERS = {
+    "grok": ("grok", "GROK_API_KEY", "https://api.x.ai/v1"),
+    "gemini": ("gemini", "GEMINI_API_KEY", "https://generativelanguage.googleapis.com/v1beta/openai/"),
+}
+DEFAULT_PROVIDER = ("openai", "OPENAI_API_KEY", None)
+
+def provider_for(model):
+    for prefix, provider in PROVIDERS.items():
         if model.startswith(prefix):
-            if not (key := os.getenv(env)):
-                st.error(f"{env} not set."); st.stop()
-            return OpenAI(api_key=key, base_url=url)
-    if not (key := os.getenv("OPENAI_API_KEY")):
-        st.error("OPENAI_API_KEY not set."); st.stop()
-    return OpenAI(api_key=key)
+            return provider
+    return DEFAULT_PROVIDER
 
+def init_client(model):
+    _, env, url = provider_for(model)
+    if not (key := os.getenv(env)):
+        st.error(f"{env} not set."); st.stop()
+    return get_client(key, url)